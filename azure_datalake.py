@@ -1,31 +1,759 @@
 import os
+import io
+import posixpath
 import json
 import re
+import time
+import threading
+import functools
+import queue
+import zlib
+import itertools
+import contextvars
+import uuid
+import weakref
+from enum import Enum
+from collections import OrderedDict
+import requests
 import numpy as np
 import pandas as pd
-from datetime import datetime
-from io import StringIO
-from pypika import Query, Field, Column, Criterion
+from datetime import datetime, timedelta, date, time as datetime_time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pypika import Query, Field, Column
 from pypika import Table as pTable
+from pypika.terms import Node
+from pypika.functions import Cast
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.filedatalake import DataLakeServiceClient
-from azure.storage.filedatalake import DelimitedTextDialect, DelimitedJsonDialect
+from azure.storage.filedatalake import DelimitedTextDialect, DelimitedJsonDialect, ArrowDialect, ArrowType
+from azure.storage.filedatalake import QuickQueryDialect
+from azure_datalake_cache import ReadCache, ResultCache
+from azure_datalake_metrics import Metrics, _instrumented, _phase, _record_response
+from azure_datalake_retry import ReadPolicy
+from azure_datalake_journal import WriteJournal, JournalPending, DEFAULT_JOURNAL_CONCURRENCY
+from azure_datalake_expr import Expr, And, Or, select, as_condition
+from azure_datalake_local import LocalQueryEngine, read_csv_result, to_output
+from normalize_timestamp import normalize_timestamp as _normalize_timestamp
+
+# block size and number of parallel connections used for uploads
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
+# number of dataframe rows serialized per appended block
+DEFAULT_BATCH_ROWS = 100_000
+# total size of the optional local read cache
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# commit thresholds of Appender
+DEFAULT_FLUSH_BYTES = 64 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 5.0
+# block size, readahead (in blocks) and cached blocks of DatalakeFile
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_READAHEAD = 8
+DEFAULT_MAX_BLOCKS = 64
+# connections kept alive per account by the shared transport
+DEFAULT_POOL_SIZE = 32
+# longest a read of a path with pending journal appends waits for their upload
+DEFAULT_JOURNAL_WAIT_TIMEOUT = 30.0
+# largest file query() downloads into the read cache to run locally
+DEFAULT_LOCAL_QUERY_MAX_BYTES = 256 * 1024 * 1024
+# directory listings kept by exists_many(ttl>0)
+DEFAULT_MAX_LISTINGS = 1024
+# attempts to use a read cache entry that another process may evict right after it is stored
+_CACHE_ENTRY_ATTEMPTS = 3
+# directory clients kept per AzureDatalakeV2 for write_binary/write_bytes
+DEFAULT_MAX_DIRECTORY_CLIENTS = 1024
+
+# process-wide registry of service and file system clients, so that every
+# AzureDatalakeV2 for the same account shares one transport and connection pool
+_registry_lock = threading.Lock()
+_service_clients = {}
+_file_system_clients = weakref.WeakKeyDictionary()
+# enforces per-call deadlines of clients without a read policy
+_DEADLINE_POLICY = ReadPolicy(max_attempts=1, hedge_quantile=None)
+
+
+def get_service_client(account_name: str = None, account_key: str = None, conn_str: str = None,
+                       pool_size: int = DEFAULT_POOL_SIZE) -> DataLakeServiceClient:
+    """アカウント毎に共有されるDataLakeServiceClientを取得する
+
+    最初の呼び出し時にpool_size本の接続を保持するHTTPトランスポートを作成し、
+    以降は同じクライアントを返す。pool_sizeもキーに含むため、同じアカウントでも
+    pool_sizeが異なる場合は別のクライアントとコネクションプールを返す。
+    レスポンス毎にMetricsへリクエスト数と転送量を記録する。
+
+    Args:
+        account_name (str, optional): ストレージアカウント名. Defaults to None.
+        account_key (str, optional): アカウントキー. Defaults to None.
+        conn_str (str, optional): 接続文字列. Defaults to None.
+        pool_size (int, optional): コネクションプールのサイズ. Defaults to DEFAULT_POOL_SIZE.
+
+    Returns:
+        DataLakeServiceClient: サービスクライアント
+    """
+    key = (conn_str, pool_size) if conn_str is not None else (account_name, account_key, pool_size)
+    with _registry_lock:
+        client = _service_clients.get(key)
+        if client is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            transport = RequestsTransport(session=session, session_owner=False)
+            if conn_str is not None:
+                client = DataLakeServiceClient.from_connection_string(
+                    conn_str=conn_str, transport=transport, raw_response_hook=_record_response)
+            else:
+                client = DataLakeServiceClient(
+                    account_url=f"https://{account_name}.dfs.core.windows.net",
+                    credential=account_key,
+                    transport=transport,
+                    raw_response_hook=_record_response
+                )
+            _service_clients[key] = client
+        return client
+
+
+def get_file_system_client(service_client: DataLakeServiceClient, container_name: str):
+    # keyed on the client object itself: an id() could be reused by a client of another account
+    # once an injected client is collected, and the entries go away with their client
+    with _registry_lock:
+        clients = _file_system_clients.get(service_client)
+        if clients is None:
+            clients = _file_system_clients[service_client] = {}
+        client = clients.get(container_name)
+        if client is None:
+            client = clients[container_name] = service_client.get_file_system_client(container_name)
+        return client
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_path(outfile: str):
+    # extract filename and directory to be saved the cloud
+    path = outfile.replace(os.sep, "/").split("/")[:-1]
+    filepath_to_store_to = os.path.join(*path) if len(path) else "./"
+    filename = os.path.normpath(outfile).split(os.sep)[-1]
+    return filepath_to_store_to, filename
+
+
+def _csv_blocks(data: pd.DataFrame, header: bool = True, batch_size: int = DEFAULT_BATCH_ROWS):
+    """Yield the frame as utf-8 encoded CSV blocks of batch_size rows."""
+    # an empty frame still yields its header
+    for start in range(0, max(len(data), 1), batch_size):
+        with _phase("normalize"):
+            batch = _normalize_timestamp(data.iloc[start:start + batch_size])
+        with _phase("serialize"):
+            block = batch.to_csv(index=False, header=header and start == 0).encode("utf-8")
+        if len(block):
+            yield block
+
+
+class BufferPool():
+    """readintoで使い回すNumPyバッファのプール
+
+    acquire(size)はsize以上の空きバッファを返し(無ければ2の累乗のサイズで確保する)、
+    使い終わったバッファはrelease()で返却する。max_buffers個を超えた返却分は破棄する。
+    """
+
+    def __init__(self, max_buffers: int = 64):
+        self.max_buffers = max_buffers
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> np.ndarray:
+        with self._lock:
+            for i, buffer in enumerate(self._free):
+                if len(buffer) >= size:
+                    return self._free.pop(i)
+        return np.empty(1 << max(size - 1, 0).bit_length(), dtype=np.uint8)
+
+    def release(self, buffer: np.ndarray):
+        # accept the views returned by readinto as well
+        while isinstance(buffer, np.ndarray) and buffer.base is not None and isinstance(buffer.base, np.ndarray):
+            buffer = buffer.base
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buffer)
+                self._free.sort(key=len)
+
+
+# compression names accepted by compression= and the extensions they are inferred from
+_COMPRESSION_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+_DONE = object()
+
+
+def _resolve_compression(compression, filepath: str):
+    if compression == "infer":
+        return _COMPRESSION_EXTENSIONS.get(os.path.splitext(filepath)[1].lower())
+    if compression not in (None, "gzip", "zstd"):
+        raise ValueError("unsupported compression: {}".format(compression))
+    return compression
+
+
+def _compressor(compression: str):
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    import zstandard
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def _decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _compress_blocks(blocks, compression: str, block_size: int = DEFAULT_CHUNK_SIZE):
+    """Compress an iterator of blocks into blocks of about block_size bytes."""
+    compressor = _compressor(compression)
+    pending = bytearray()
+    for block in blocks:
+        with _phase("compress"):
+            pending += compressor.compress(block)
+        if len(pending) >= block_size:
+            yield bytes(pending)
+            pending.clear()
+    pending += compressor.flush()
+    if pending:
+        yield bytes(pending)
+
+
+def _decompress_chunks(chunks, compression: str):
+    """Decompress an iterator of chunks, including concatenated gzip members or zstd frames
+    as produced by appending to a compressed file."""
+    decompressor = _decompressor(compression)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = _decompressor(compression)
+
+
+def _file_chunks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+
+def _reader_chunks(f, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    # like _file_chunks for a file opened by the caller, closed once exhausted
+    with f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+
+def _threaded(iterable, maxsize: int = 2):
+    """Run an iterator in a worker thread so that producing items (compression,
+    serialization) overlaps with consuming them (network I/O)."""
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            for item in iterable:
+                put(item)
+                if stop.is_set():
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    # the worker runs in a copy of the caller's context so that its phases are measured
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class _AppendWriter(io.RawIOBase):
+    """Writable stream that appends to a file client in blocks of block_size
+    and commits everything with one flush_data on close."""
+
+    def __init__(self, file_client, offset: int = 0, block_size: int = DEFAULT_CHUNK_SIZE, metrics: Metrics = None):
+        self.file_client = file_client
+        self.offset = offset
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.result = None
+        self.metrics = metrics
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.buffer += b
+        if len(self.buffer) >= self.block_size:
+            self._append()
+        return len(b)
+
+    def tell(self):
+        return self.offset + len(self.buffer)
+
+    def _append(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            with _phase("upload"):
+                self.file_client.append_data(data, offset=self.offset, length=len(data))
+            self.offset += len(data)
+            self.buffer.clear()
+
+    def close(self):
+        if not self.closed:
+            self._append()
+            with _phase("flush"):
+                self.result = self.file_client.flush_data(self.offset)
+        super().close()
+
+
+class Appender(_AppendWriter):
+    """追記用のセッション
+
+    書き込んだデータはblock_size毎にまとめてappendし、未確定のデータが
+    flush_bytesを超えた時、前回の確定からflush_interval秒経過した時、
+    flush()を呼んだ時、およびclose時にflush_dataで確定する。経過時間による確定は
+    書き込みが止まっていてもバックグラウンドのスレッドが行い、そこで発生した例外は
+    次のwrite/flush/closeで送出する。オフセットは手元で管理するため、
+    追記の度にファイルのプロパティを取得しない。
+
+    with client.appender("log.csv") as appender:
+        appender.write(df)
+    """
+
+    def __init__(self, file_client, offset: int = 0, block_size: int = DEFAULT_CHUNK_SIZE,
+                 flush_bytes: int = DEFAULT_FLUSH_BYTES, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 metrics: Metrics = None):
+        super().__init__(file_client, offset, block_size, metrics)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.committed = offset
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._error = None
+        self._stop = threading.Event()
+        if flush_interval is not None:
+            # the thread holds a weak reference, so an abandoned appender can still be collected
+            threading.Thread(target=_flush_periodically, args=(weakref.ref(self), self._stop, flush_interval),
+                             name="appender-flush", daemon=True).start()
+
+    @_instrumented(name="appender.write")
+    def write(self, data):
+        """データを追記する
 
+        Args:
+            data (pd.DataFrame, str or bytes): 追記するデータ. データフレームは空のファイルに
+                書き込む場合のみヘッダーを付けたCSVに変換する
 
-class AzureDatalakeV2():
-    def __init__(self, account_name: str = None, account_key: str = None, container_name: str = None, conn_str: str = None):
-        self.conn = None
-        self.container = None
-        if conn_str is not None:
-            self.conn = DataLakeServiceClient.from_connection_string(
-                conn_str=conn_str)
-            self.container = self.conn.get_file_system_client(container_name)
+        Returns:
+            int: 追記したバイト数
+        """
+        with self._lock:
+            if self.closed:
+                raise ValueError("I/O operation on closed file")
+            self._raise_error()
+            start = self.tell()
+            if isinstance(data, pd.DataFrame):
+                for block in _csv_blocks(data, header=start == 0):
+                    super().write(block)
+            else:
+                super().write(data.encode("utf-8") if isinstance(data, str) else data)
+
+            if self.tell() - self.committed >= self.flush_bytes or self._flush_due():
+                self.flush()
+            return self.tell() - start
+
+    @_instrumented(name="appender.flush")
+    def flush(self):
+        with self._lock:
+            if self.closed:
+                raise ValueError("I/O operation on closed file")
+            self._raise_error()
+            self._append()
+            if self.offset != self.committed:
+                with _phase("flush"):
+                    self.result = self.file_client.flush_data(self.offset)
+                self.committed = self.offset
+            self._last_flush = time.monotonic()
+
+    @_instrumented(name="appender.close")
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            if not self.closed:
+                # the flush below retries whatever a failed background flush left uncommitted
+                self._error = None
+                try:
+                    self.flush()
+                finally:
+                    io.RawIOBase.close(self)
+
+    def _flush_due(self) -> bool:
+        return self.flush_interval is not None and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def _flush_in_background(self) -> float:
+        # called by _flush_periodically, returns the seconds until the next flush is due
+        with self._lock:
+            if self.closed:
+                return None
+            if self._flush_due():
+                if self.tell() == self.committed:
+                    self._last_flush = time.monotonic()
+                elif self._error is None:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        # surfaced by the next call of the owner, which then retries
+                        self._error = e
+                        self._last_flush = time.monotonic()
+            return max(self.flush_interval - (time.monotonic() - self._last_flush), 0)
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+
+def _flush_periodically(ref, stop, delay):
+    while not stop.wait(delay):
+        appender = ref()
+        if appender is None:
+            return
+        delay = appender._flush_in_background()
+        del appender
+        if delay is None:
+            return
+
+
+class DatalakeFile(io.RawIOBase):
+    """ストレージ上のファイルを範囲ダウンロードで読む、シーク可能な読み込み専用ストリーム
+
+    block_size単位でダウンロードしたブロックを最大max_blocks個キャッシュする。
+    連続したブロックを読んでいる間は、次のreadahead個のブロックも同じリクエストで取得する。
+    block_size以上の読み込みはキャッシュを通さず、その範囲だけをダウンロードする。
+    """
+
+    def __init__(self, file_client, size: int = None, block_size: int = DEFAULT_BLOCK_SIZE,
+                 readahead: int = DEFAULT_READAHEAD, max_blocks: int = DEFAULT_MAX_BLOCKS, metrics: Metrics = None):
+        self.file_client = file_client
+        self.metrics = metrics
+        self.size = file_client.get_file_properties()['size'] if size is None else size
+        self.block_size = block_size
+        self.readahead = readahead
+        self.max_blocks = max_blocks
+        self.position = 0
+        self.bytes_read = 0
+        self.requests = 0
+        self._blocks = OrderedDict()
+        self._last_block = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
         else:
-            self.conn = DataLakeServiceClient(
-                account_url=f"https://{account_name}.dfs.core.windows.net",
-                credential=account_key
-            )
-            self.container = self.conn.get_file_system_client(container_name)
+            raise ValueError("invalid whence ({})".format(whence))
+        if self.position < 0:
+            raise ValueError("negative seek position {}".format(self.position))
+        return self.position
+
+    @_instrumented(name="file.readinto")
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        length = min(len(view), self.size - self.position)
+        if length <= 0:
+            return 0
+
+        if length >= self.block_size:
+            data = self._download(self.position, length)
+            view[:len(data)] = data
+            self.position += len(data)
+            return len(data)
+
+        filled = 0
+        while filled < length:
+            index, start = divmod(self.position, self.block_size)
+            block = self._block(index)
+            n = min(length - filled, len(block) - start)
+            if n <= 0:
+                break
+            view[filled:filled + n] = block[start:start + n]
+            filled += n
+            self.position += n
+        return filled
+
+    def _block(self, index: int) -> bytes:
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+
+        # read ahead only while the access pattern is sequential
+        count = 1 + (self.readahead if self._last_block == index - 1 else 0)
+        offset = index * self.block_size
+        data = self._download(offset, min(count * self.block_size, self.size - offset))
+        for i in range(0, len(data), self.block_size):
+            self._blocks[index + i // self.block_size] = data[i:i + self.block_size]
+            self._blocks.move_to_end(index + i // self.block_size)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        self._last_block = index + max(count - 1, 0)
+        return self._blocks.get(index, b"")
+
+    def _download(self, offset: int, length: int) -> bytes:
+        with _phase("download"):
+            data = self.file_client.download_file(offset=offset, length=length).readall()
+        self.requests += 1
+        self.bytes_read += len(data)
+        return data
+
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only stream over an iterator of downloaded chunks, so that parsers
+    can consume the data while the rest of the download is still in flight."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.pending):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        length = min(len(b), len(self.pending))
+        b[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+
+def _input_dialect(file_format: str):
+    # dialect of the file being queried
+    if file_format == "csv":
+        return DelimitedTextDialect(delimiter=',', quotechar='"', escapechar="", has_header=True)
+    if file_format == "json":
+        return DelimitedJsonDialect(delimiter='\n')
+    if file_format == "parquet":
+        return QuickQueryDialect.PARQUET
+    raise ValueError("unsupported file_format: {}".format(file_format))
+
+
+def _query_records(file_client, sql_query: str, file_format: str, **kwargs):
+    # setup formatter, one json object per line
+    output_format = DelimitedJsonDialect(delimiter='\n')
+
+    # parse the records as they arrive
+    reader = file_client.query_file(
+        sql_query, file_format=_input_dialect(file_format), output_format=output_format, **kwargs)
+    return (json.loads(record) for record in reader.records() if record)
+
+
+def _may_match(op, lower, upper, value) -> bool:
+    """Return False only when min/max statistics prove that no row satisfies
+    `column <op> value`."""
+    if lower is None or upper is None:
+        return True
+    try:
+        if isinstance(lower, (datetime, np.datetime64, pd.Timestamp)):
+            lower, upper = _as_utc(lower), _as_utc(upper)
+            value = [_as_utc(v) for v in value] if op in ("in", "not in") else _as_utc(value)
+        if op in ("==", "="):
+            return lower <= value <= upper
+        if op == "<":
+            return lower < value
+        if op == "<=":
+            return lower <= value
+        if op == ">":
+            return upper > value
+        if op == ">=":
+            return upper >= value
+        if op == "in":
+            return any(lower <= v <= upper for v in value)
+    except TypeError:
+        pass
+    return True
+
+
+def _as_utc(value) -> pd.Timestamp:
+    value = pd.Timestamp(value)
+    return value.tz_localize("utc") if value.tzinfo is None else value.tz_convert("utc")
+
+
+def _filter_mask(series: pd.Series, op, value) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        value = [_as_utc(v) for v in value] if op in ("in", "not in") else _as_utc(value)
+        if series.dt.tz is None:
+            series = series.dt.tz_localize("utc")
+    if op in ("==", "="):
+        return series == value
+    if op == "!=":
+        return series != value
+    if op == "<":
+        return series < value
+    if op == "<=":
+        return series <= value
+    if op == ">":
+        return series > value
+    if op == ">=":
+        return series >= value
+    if op == "in":
+        return series.isin(value)
+    if op == "not in":
+        return ~series.isin(value)
+    raise ValueError("unsupported filter operator: {}".format(op))
+
+
+class AzureDatalakeV2():
+    def __init__(self, account_name: str = None, account_key: str = None, container_name: str = None, conn_str: str = None,
+                 cache_dir: str = None, cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES, pool_size: int = DEFAULT_POOL_SIZE,
+                 service_client=None, metrics: Metrics = None, read_policy: ReadPolicy = None,
+                 journal_dir: str = None, journal_concurrency: int = DEFAULT_JOURNAL_CONCURRENCY,
+                 journal_max_bytes: int = None, journal_wait_timeout: float = DEFAULT_JOURNAL_WAIT_TIMEOUT,
+                 local_query_max_bytes: int = DEFAULT_LOCAL_QUERY_MAX_BYTES,
+                 result_cache: ResultCache = None):
+        # service_client is used as is when given (e.g. the fake in azure_datalake_benchmark)
+        self.conn = service_client if service_client is not None else get_service_client(
+            account_name, account_key, conn_str, pool_size)
+        self.container = get_file_system_client(self.conn, container_name)
+        # directory -> directory client used by _create_file, least recently used first
+        self._directory_clients = OrderedDict()
+        self._directory_clients_lock = threading.Lock()
+        # opt-in on-disk read cache validated by ETag
+        self.cache = ReadCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        # directory -> (expiry time, set of file paths) used by exists_many, least recently used first
+        self._listings = OrderedDict()
+        self._listings_lock = threading.Lock()
+        # opt-in sink of per-operation durations, phases, requests and bytes
+        self.metrics = metrics
+        # opt-in deadline, retry and hedging of read_bytes/read_range
+        self.read_policy = read_policy
+        # opt-in write-back tier: writes land in a local journal uploaded in the background
+        self.journal = WriteJournal(journal_dir, self._upload_batch, journal_concurrency,
+                                    max_bytes=journal_max_bytes) if journal_dir is not None else None
+        # reads that need the uploaded file raise JournalPending after waiting this long (None: forever)
+        self.journal_wait_timeout = journal_wait_timeout
+        # query() runs on a cached copy with DuckDB when the file is cached or at most this size
+        self.local_query_max_bytes = local_query_max_bytes
+        self._local_engine = None
+        # opt-in cache of query_csv results keyed by path, ETag and SQL
+        self.result_cache = result_cache
+
+    @_instrumented
+    def flush(self, timeout: float = None) -> bool:
+        """ジャーナルに書き込んだデータのうち、呼び出し時点までの分のアップロードを待つ
+
+        Args:
+            timeout (float, optional): 最大の待ち時間(秒). Defaults to None.
+
+        Returns:
+            bool: 期限内に完了した場合はTRUE (ジャーナルを使わない場合は常にTRUE)
+        """
+        return self.journal is None or self.journal.flush(timeout)
 
+    @_instrumented
+    def wait_for_drain(self, timeout: float = None) -> bool:
+        """ジャーナルが空になるまで待つ
+
+        Args:
+            timeout (float, optional): 最大の待ち時間(秒). Defaults to None.
+
+        Returns:
+            bool: 期限内に空になった場合はTRUE (ジャーナルを使わない場合は常にTRUE)
+        """
+        return self.journal is None or self.journal.wait_for_drain(timeout)
+
+    @_instrumented
+    def close(self, timeout: float = None) -> bool:
+        """ジャーナルのアップロードを待ってからアップローダーを止める
+
+        期限までに送れなかったデータはジャーナルに残り、同じjournal_dirで次に起動した時に送る.
+
+        Args:
+            timeout (float, optional): 最大の待ち時間(秒). Defaults to None.
+
+        Returns:
+            bool: 全て送れた場合はTRUE
+        """
+        return self.journal is None or self.journal.close(timeout)
+
+    def _upload_batch(self, batch):
+        # upload a batch of the write-back journal, called from its uploader threads
+        blocks = itertools.chain.from_iterable(_file_chunks(path) for path in batch.files)
+        if not batch.append:
+            file_client = self._create_file(batch.path)
+            file_client.flush_data(self._append_blocks(file_client, blocks))
+            return
+
+        file_client = self.container.get_file_client(batch.path)
+        try:
+            size = file_client.get_file_properties()['size']
+        except ResourceNotFoundError:
+            file_client.create_file()
+            self._forget_listing(batch.path)
+            size = 0
+        if batch.offset is not None and size == batch.offset + batch.length:
+            # flushed before the process stopped, appending again would duplicate it
+            return
+        batch.checkpoint(size)
+        file_client.flush_data(self._append_blocks(file_client, blocks, size))
+
+    def _journal_read(self, filepath: str):
+        # content of a path still in the journal, None when it has to be read from the storage
+        if self.journal is None:
+            return None
+        path = filepath.replace(os.sep, "/")
+        data = self.journal.read(path)
+        if data is False:
+            # only appends are pending, so the storage holds the beginning of the file
+            self._journal_wait(path)
+            return None
+        return data
+
+    def _journal_wait(self, filepath: str):
+        # operations that cannot be served locally see the uploaded file
+        if self.journal is None:
+            return
+        path = filepath.replace(os.sep, "/")
+        if not self.journal.wait_for_path(path, self.journal_wait_timeout):
+            raise JournalPending("{} is still being uploaded from the journal after {}s (last error: {!r})".format(
+                path, self.journal_wait_timeout, self.journal.last_error))
+
+    @_instrumented
     def blob_exists(self, filepath: str) -> bool:
         """指定したファイルが存在するか確認する
 
@@ -36,156 +764,837 @@ class AzureDatalakeV2():
             bool: 存在する場合はTRUE、しない場合はFALSE
         """
         filepath = filepath.replace(os.sep, "/")
+        if self.journal is not None and self.journal.pending(filepath):
+            return True
         file_client = self.container.get_file_client(filepath)
         return file_client.exists()
 
-    def write_binary(self, outfile: str, infile: str):
+    @_instrumented
+    def exists_many(self, filepaths, ttl: float = 0) -> dict:
+        """複数のファイルが存在するか、親ディレクトリ毎に一度の一覧取得で確認する
+
+        Args:
+            filepaths (list): ファイルパスのリスト
+            ttl (float, optional): ディレクトリ一覧を再利用する秒数. 0の場合は毎回取得する.
+                このクライアントがファイルを作成したディレクトリの一覧は破棄する. Defaults to 0.
+
+        Returns:
+            dict: ファイルパスをキー、存在する場合はTRUEを値とするdict
+        """
+        normalized = {filepath: filepath.replace(os.sep, "/").strip("/") for filepath in filepaths}
+        directories = {posixpath.dirname(path) for path in normalized.values()}
+        listings = {directory: self._list_directory(directory, ttl) for directory in directories}
+        pending = self.journal.pending if self.journal is not None else lambda path: False
+        return {filepath: path in listings[posixpath.dirname(path)] or pending(path)
+                for filepath, path in normalized.items()}
+
+    def _list_directory(self, directory: str, ttl: float) -> set:
+        now = time.monotonic()
+        with self._listings_lock:
+            cached = self._listings.get(directory)
+            if cached is not None and cached[0] > now:
+                self._listings.move_to_end(directory)
+                return cached[1]
+
+        try:
+            names = {item.name.strip("/") for item in self.container.get_paths(
+                path=directory or None, recursive=False) if not item.is_directory}
+        except ResourceNotFoundError:
+            names = set()
+        if ttl > 0:
+            with self._listings_lock:
+                self._listings[directory] = (now + ttl, names)
+                self._listings.move_to_end(directory)
+                while len(self._listings) > DEFAULT_MAX_LISTINGS:
+                    self._listings.popitem(last=False)
+        return names
+
+    def _forget_listing(self, filepath: str):
+        # a file written by this client may be missing from the listing exists_many keeps
+        directory = posixpath.dirname(filepath.replace(os.sep, "/").strip("/"))
+        with self._listings_lock:
+            self._listings.pop(directory, None)
+
+    @_instrumented
+    def write_binary(self, outfile: str, infile: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                     max_concurrency: int = DEFAULT_MAX_CONCURRENCY, progress_callback=None, compression=None):
         """指定したファイルをバイナリファイルでストレージにアップロードする
 
+        ファイルをchunk_size毎のブロックに分割し、max_concurrency本のスレッドで
+        並列にappendした後、最後に一度だけflushする。メモリ使用量は
+        おおよそchunk_size × max_concurrencyに収まる。
+        圧縮する場合は、ワーカースレッドで圧縮したブロックを順にappendする。
+
         Args:
             outfile (str): ストレージのパス
             infile (str): ローカルファイルのパス
+            chunk_size (int, optional): ブロックサイズ(byte). Defaults to DEFAULT_CHUNK_SIZE.
+            max_concurrency (int, optional): 並列数. Defaults to DEFAULT_MAX_CONCURRENCY.
+            progress_callback (callable, optional): 進捗コールバック.
+                callback(uploaded_bytes, total_bytes, elapsed_seconds)で呼ばれる.
+                圧縮する場合は読み込んだ元ファイルのバイト数を渡す. Defaults to None.
+            compression (str, optional): 圧縮形式(gzip, zstd, infer). inferは拡張子から判定する.
+                Defaults to None.
 
         Returns:
             _type_: ストレージのヘッダー情報
         """
-        # extract filename and directory to be saved the cloud
-        path = outfile.replace(os.sep, "/").split("/")[:-1]
-        filepath_to_store_to = os.path.join(*path) if len(path) else "./"
-        filename = os.path.normpath(outfile).split(os.sep)[-1]
-
-        # create or get directory client
-        directory_client = self.container.get_directory_client(
-            filepath_to_store_to)
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
 
         # upload file
-        file_client = directory_client.create_file(filename)
-        with open(infile, "rb") as data:
-            size = os.fstat(data.fileno()).st_size
-            file_client.append_data(data, offset=0, length=size)
+        file_client = self._create_file(outfile)
+        size = os.path.getsize(infile)
+        compression = _resolve_compression(compression, outfile)
+        if compression is not None:
+            return self._write_compressed_binary(file_client, infile, size, chunk_size,
+                                                 progress_callback, compression)
+
+        ranges = [(offset, min(chunk_size, size - offset))
+                  for offset in range(0, size, chunk_size)]
+
+        lock = threading.Lock()
+        uploaded = 0
+        started = time.perf_counter()
+
+        def upload_range(offset, length):
+            nonlocal uploaded
+            # every worker reads its own range so that only the blocks
+            # currently in flight are held in memory
+            with open(infile, "rb") as data:
+                data.seek(offset)
+                block = data.read(length)
+            with _phase("upload"):
+                file_client.append_data(block, offset=offset, length=length)
+            with lock:
+                uploaded += length
+                if progress_callback is not None:
+                    progress_callback(uploaded, size,
+                                      time.perf_counter() - started)
+
+        if len(ranges) == 1 or max_concurrency <= 1:
+            for offset, length in ranges:
+                upload_range(offset, length)
+        else:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, upload_range, offset, length)
+                           for offset, length in ranges]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
 
         # flush data once the process is completed
-        return file_client.flush_data(size)
-
-    def write_bytes(self, outfile: str, memstring: str, metadata=None):
+        with _phase("flush"):
+            return file_client.flush_data(size)
+
+    def _write_compressed_binary(self, file_client, infile, size, chunk_size, progress_callback, compression):
+        consumed = 0
+        started = time.perf_counter()
+
+        def read_blocks():
+            nonlocal consumed
+            with open(infile, "rb") as data:
+                for block in iter(lambda: data.read(chunk_size), b""):
+                    consumed += len(block)
+                    yield block
+
+        def on_block(offset):
+            if progress_callback is not None:
+                progress_callback(consumed, size, time.perf_counter() - started)
+
+        blocks = _threaded(_compress_blocks(read_blocks(), compression, chunk_size))
+        offset = self._append_blocks(file_client, blocks, 0, on_block)
+        with _phase("flush"):
+            return file_client.flush_data(offset)
+
+    def _append_blocks(self, file_client, blocks, offset: int = 0, on_block=None) -> int:
+        # append the blocks one after another and return the end offset
+        for block in blocks:
+            with _phase("upload"):
+                file_client.append_data(block, offset=offset, length=len(block))
+            offset += len(block)
+            if on_block is not None:
+                on_block(offset)
+        return offset
+
+    def _create_file(self, outfile: str):
+        self._forget_listing(outfile)
+        # create or get directory client
+        filepath_to_store_to, filename = _split_path(outfile)
+        with self._directory_clients_lock:
+            directory_client = self._directory_clients.get(filepath_to_store_to)
+            if directory_client is None:
+                directory_client = self._directory_clients[filepath_to_store_to] = \
+                    self.container.get_directory_client(filepath_to_store_to)
+                while len(self._directory_clients) > DEFAULT_MAX_DIRECTORY_CLIENTS:
+                    self._directory_clients.popitem(last=False)
+            else:
+                self._directory_clients.move_to_end(filepath_to_store_to)
+        return directory_client.create_file(filename)
+
+    @_instrumented
+    def write_bytes(self, outfile: str, memstring: str, metadata=None, compression=None):
         """文字列データをストレージにアップロードする
 
         Args:
             outfile (str): ストレージのパス
             memstring (str): 文字列データ
             metadata (_type_, optional): メタデータ. Defaults to None.
+            compression (str, optional): 圧縮形式(gzip, zstd, infer). Defaults to None.
 
         Returns:
-            _type_: ストレージのヘッダー情報
+            _type_: ストレージのヘッダー情報 (ジャーナル使用時はNone)
         """
-        # extract filename and directory to be saved the cloud
-        path = outfile.replace(os.sep, "/").split("/")[:-1]
-        filepath_to_store_to = os.path.join(*path) if len(path) else "./"
-        filename = os.path.normpath(outfile).split(os.sep)[-1]
-
-        # create or get directory client
-        directory_client = self.container.get_directory_client(
-            filepath_to_store_to)
+        data = memstring.encode("utf-8") if isinstance(memstring, str) else memstring
+        compression = _resolve_compression(compression, outfile)
+        if self.journal is not None:
+            blocks = [data] if compression is None else _compress_blocks([data], compression)
+            self.journal.add(outfile.replace(os.sep, "/"), blocks)
+            return None
 
         # upload file
-        file_client = directory_client.create_file(filename)
-        file_client.append_data(data=memstring, offset=0,
-                                length=len(memstring.encode("utf-8")))
+        file_client = self._create_file(outfile)
+        if compression is not None:
+            view = memoryview(data)
+            blocks = (view[i:i + DEFAULT_CHUNK_SIZE] for i in range(0, len(view), DEFAULT_CHUNK_SIZE))
+            offset = self._append_blocks(file_client, _threaded(_compress_blocks(blocks, compression)))
+            with _phase("flush"):
+                return file_client.flush_data(offset)
+        with _phase("upload"):
+            file_client.append_data(data=data, offset=0, length=len(data))
 
         # flush data once the process is completed
-        return file_client.flush_data(len(memstring.encode("utf-8")))
+        with _phase("flush"):
+            return file_client.flush_data(len(data))
 
-    def write_dataframe(self, filepath: str, data: pd.DataFrame, append=False):
+    @_instrumented
+    def write_dataframe(self, filepath: str, data: pd.DataFrame, append=False, batch_size: int = DEFAULT_BATCH_ROWS,
+                        compression=None):
         """Pandasデータフレームをストレージにアップロードする
 
+        データフレームをbatch_size行毎にCSVへ変換してappendするため、
+        メモリ使用量はデータフレーム全体ではなくバッチサイズに比例する。
+
         Args:
             filepath (str): ストレージのパス
             data (pd.DataFrame): pandasデータフレーム
             append (bool, optional): TRUEは追記、FALSEは書き込み. デファクトはFALSE
+            batch_size (int, optional): 1回のappendで送る行数. Defaults to DEFAULT_BATCH_ROWS.
+            compression (str, optional): 圧縮形式(gzip, zstd, infer). 追記時は新しい
+                gzipメンバー/zstdフレームとして連結する. Defaults to None.
 
         Returns:
-            _type_: ストレージのヘッダー情報
+            _type_: ストレージのヘッダー情報 (ジャーナル使用時はNone)
         """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+
+        blocks = _csv_blocks(data, header=not append, batch_size=batch_size)
+        compression = _resolve_compression(compression, filepath)
+        if compression is not None:
+            blocks = _threaded(_compress_blocks(blocks, compression))
+        if self.journal is not None:
+            self.journal.add(filepath.replace(os.sep, "/"), blocks, append=append)
+            return None
+
         file_client = self.container.get_file_client(
             filepath.replace(os.sep, "/"))
-        data = self.__normalize_timestamp__(data)
         if append:
-            data: str = data.to_csv(index=False, header=False)
             # offset size must be known
             offset = file_client.get_file_properties()['size']
-            file_client.append_data(data, offset)
-
-            # upload data to cloud
-            return file_client.flush_data(offset + len(data.encode("utf-8")))
         else:
-            data = data.to_csv(index=False, header=True)
             file_client.create_file()
-            return self.write_bytes(filepath, data)
+            self._forget_listing(filepath)
+            offset = 0
+        offset = self._append_blocks(file_client, blocks, offset)
+
+        # upload data to cloud
+        with _phase("flush"):
+            return file_client.flush_data(offset)
+
+    @_instrumented
+    def appender(self, filepath: str, block_size: int = DEFAULT_CHUNK_SIZE, flush_bytes: int = DEFAULT_FLUSH_BYTES,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> Appender:
+        """追記用のセッションを開始する. ファイルが無い場合は作成する
+
+        Args:
+            filepath (str): ストレージのパス
+            block_size (int, optional): まとめてappendするサイズ(byte). Defaults to DEFAULT_CHUNK_SIZE.
+            flush_bytes (int, optional): 確定するまでに溜める最大サイズ(byte). Defaults to DEFAULT_FLUSH_BYTES.
+            flush_interval (float, optional): 確定する間隔(秒). 書き込みが無い間もバックグラウンドの
+                スレッドが確定する. Noneの場合は経過時間では確定しない. Defaults to DEFAULT_FLUSH_INTERVAL.
+
+        Returns:
+            Appender: 追記用のセッション
+        """
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        try:
+            offset = file_client.get_file_properties()['size']
+        except ResourceNotFoundError:
+            file_client.create_file()
+            self._forget_listing(filepath)
+            offset = 0
+        return Appender(file_client, offset, block_size, flush_bytes, flush_interval, self.metrics)
+
+    @_instrumented
+    def write_parquet(self, filepath: str, data: pd.DataFrame, row_group_size: int = DEFAULT_BATCH_ROWS,
+                      compression: str = "snappy"):
+        """Pandasデータフレームをparquet形式でストレージにアップロードする
+
+        row_group_size行毎にrow groupを作成し、書き込んだ順にappendする。
+
+        Args:
+            filepath (str): ストレージのパス
+            data (pd.DataFrame): pandasデータフレーム
+            row_group_size (int, optional): row groupの行数. Defaults to DEFAULT_BATCH_ROWS.
+            compression (str, optional): 圧縮形式. Defaults to "snappy".
+
+        Returns:
+            _type_: ストレージのヘッダー情報
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if row_group_size <= 0:
+            raise ValueError("row_group_size must be positive")
+
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        file_client.create_file()
+        self._forget_listing(filepath)
+
+        stream = _AppendWriter(file_client)
+        schema = pa.Schema.from_pandas(data, preserve_index=False)
+        with pq.ParquetWriter(stream, schema, compression=compression) as writer:
+            for start in range(0, len(data), row_group_size):
+                batch = data.iloc[start:start + row_group_size]
+                writer.write_table(pa.Table.from_pandas(
+                    batch, schema=schema, preserve_index=False))
+        stream.close()
+        return stream.result
+
+    @_instrumented
+    def read_parquet(self, filepath: str, columns=None, filters=None) -> pd.DataFrame:
+        """ストレージ上のparquetファイルを読み込み
+
+        フッターと、必要な列およびfiltersに一致し得るrow groupのバイト範囲のみを
+        ダウンロードする。row groupの選別はmin/max統計量で行い、
+        最後に行単位でfiltersを適用する。
+
+        Args:
+            filepath (str): ファイルのパス
+            columns (list, optional): 読み込む列. Defaults to None (全列).
+            filters (list, optional): (列名, 演算子, 値)のリスト. 全条件のANDで評価する.
+                演算子は==, !=, <, <=, >, >=, in, not in. Defaults to None.
+
+        Returns:
+            pd.DataFrame: pandasデータフレーム
+        """
+        import pyarrow.parquet as pq
 
-    def read_bytes(self, filepath: str) -> bytes:
+        filters = list(filters or [])
+        self._journal_wait(filepath)
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        source = DatalakeFile(file_client, readahead=0)
+        parquet_file = pq.ParquetFile(source)
+        metadata = parquet_file.metadata
+
+        # keep only row groups whose statistics can satisfy every filter
+        row_groups = []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            stats = {}
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.is_stats_set and column.statistics.has_min_max:
+                    stats[column.path_in_schema] = (
+                        column.statistics.min, column.statistics.max)
+            if all(_may_match(op, *stats.get(name, (None, None)), value)
+                   for name, op, value in filters):
+                row_groups.append(i)
+
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns) + [
+                name for name, _, _ in filters if name not in columns]
+        table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+        df = table.to_pandas()
+
+        if filters:
+            mask = np.ones(len(df), dtype=bool)
+            for name, op, value in filters:
+                mask &= _filter_mask(df[name], op, value).to_numpy(dtype=bool)
+            df = df[mask].reset_index(drop=True)
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    @_instrumented
+    def read_bytes(self, filepath: str, compression=None, deadline: float = None) -> bytes:
         """ストレージ上のファイルをダウンロード
 
         Args:
             filepath (str): ファイルのパス
+            compression (str, optional): 圧縮形式(gzip, zstd, infer). 指定した場合は
+                ダウンロードしながら展開する. Defaults to None.
+            deadline (float, optional): 期限(秒). 超えた場合はDeadlineExceededを送出する.
+                Defaults to None (read_policyの期限).
 
         Returns:
             bytes: バイナリデータ
         """
+        compression = _resolve_compression(compression, filepath)
+        local = self._journal_read(filepath)
+        if local is not None:
+            return local if compression is None else b"".join(_decompress_chunks([local], compression))
+
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        if self.cache is not None:
+            with self._open_cached(file_client, deadline=deadline) as f:
+                if compression is None:
+                    return f.read()
+                return b"".join(_threaded(_decompress_chunks(iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b""),
+                                                             compression)))
+        if compression is not None and self.read_policy is None and deadline is None:
+            return b"".join(self._iter_chunks(file_client, compression))
+        # a retried or hedged attempt restarts the download, so the whole file is read before decompressing
+        data = self._read(lambda: file_client.download_file().readall(), deadline)
+        return data if compression is None else b"".join(_decompress_chunks([data], compression))
+
+    def _iter_chunks(self, file_client, compression=None):
+        # chunks of the file from the cache or the download, decompressed in a worker thread
+        if self.cache is None:
+            chunks = file_client.download_file().chunks()
+        else:
+            chunks = _reader_chunks(self._open_cached(file_client))
+        if compression is not None:
+            chunks = _threaded(_decompress_chunks(chunks, compression))
+        return chunks
+
+    @_instrumented
+    def read_range(self, filepath: str, offset: int, length: int = None, deadline: float = None) -> bytes:
+        """ストレージ上のファイルの一部をダウンロード
+
+        Args:
+            filepath (str): ファイルのパス
+            offset (int): 開始位置(byte)
+            length (int, optional): 読み込むサイズ(byte). Defaults to None (末尾まで).
+            deadline (float, optional): 期限(秒). Defaults to None (read_policyの期限).
+
+        Returns:
+            bytes: バイナリデータ
+        """
+        local = self._journal_read(filepath)
+        if local is not None:
+            return local[offset:None if length is None else offset + length]
+
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        return self._read(lambda: file_client.download_file(offset=offset, length=length).readall(), deadline)
+
+    def _read(self, download, deadline: float = None, phase: str = "download"):
+        # run an idempotent request under the read policy, if any
+        policy = self.read_policy
+        if policy is None:
+            if deadline is None:
+                with _phase(phase):
+                    return download()
+            policy = _DEADLINE_POLICY
+        with _phase(phase):
+            return policy.call(download, deadline)
+
+    @_instrumented
+    def open(self, filepath: str, mode: str = "rb", block_size: int = DEFAULT_BLOCK_SIZE,
+             readahead: int = DEFAULT_READAHEAD, max_blocks: int = DEFAULT_MAX_BLOCKS) -> DatalakeFile:
+        """ストレージ上のファイルをシーク可能なストリームとして開く
+
+        Args:
+            filepath (str): ファイルのパス
+            mode (str, optional): "rb"のみ対応. Defaults to "rb".
+            block_size (int, optional): ダウンロードの単位(byte). Defaults to DEFAULT_BLOCK_SIZE.
+            readahead (int, optional): 連続読み込み時に先読みするブロック数. Defaults to DEFAULT_READAHEAD.
+            max_blocks (int, optional): キャッシュするブロック数. Defaults to DEFAULT_MAX_BLOCKS.
+
+        Returns:
+            DatalakeFile: 読み込み専用のストリーム
+        """
+        if mode != "rb":
+            raise ValueError("only mode 'rb' is supported, got {!r}".format(mode))
+        self._journal_wait(filepath)
         file_client = self.container.get_file_client(
             filepath.replace(os.sep, "/"))
-        return file_client.download_file().readall()
+        return DatalakeFile(file_client, block_size=block_size, readahead=readahead, max_blocks=max_blocks,
+                            metrics=self.metrics)
 
-    def read_image(self, filepath: str) -> np.ndarray:
+    @_instrumented
+    def readinto(self, filepath: str, buffer=None, pool: BufferPool = None):
+        """ストレージ上のファイルを指定したバッファへ直接ダウンロード
+
+        Args:
+            filepath (str): ファイルのパス
+            buffer (optional): 書き込み先のbytearrayまたはnp.uint8配列. Defaults to None.
+            pool (BufferPool, optional): bufferが無い場合に確保に使うプール. Defaults to None.
+
+        Returns:
+            np.ndarray: ファイルサイズ分のビュー (bufferがbytearrayの場合はmemoryview)
+        """
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        local = self._journal_read(filepath)
+        if local is not None:
+            size = len(local)
+        elif self.cache is None:
+            download = file_client.download_file()
+            size = download.size
+        else:
+            source = self._open_cached(file_client)
+            size = os.fstat(source.fileno()).st_size
+
+        try:
+            if buffer is None:
+                buffer = pool.acquire(size) if pool is not None else np.empty(size, dtype=np.uint8)
+            view = memoryview(buffer).cast("B")
+            if len(view) < size:
+                raise ValueError("buffer is smaller than the file ({} < {} bytes)".format(len(view), size))
+
+            position = 0
+            if local is not None:
+                view[:size] = local
+                position = size
+            elif self.cache is None:
+                for chunk in download.chunks():
+                    view[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+            else:
+                while position < size:
+                    read = source.readinto(view[position:size])
+                    if not read:
+                        break
+                    position += read
+        finally:
+            if local is None and self.cache is not None:
+                source.close()
+        return buffer[:position] if isinstance(buffer, np.ndarray) else view[:position]
+
+    @_instrumented
+    def read_image(self, filepath: str, buffer=None, pool: BufferPool = None) -> np.ndarray:
         """ストレージ上の画像を読み込み
 
         Args:
             filepath (str): ファイルパス
+            buffer (np.ndarray, optional): 書き込み先のバッファ. Defaults to None.
+            pool (BufferPool, optional): バッファを確保するプール. Defaults to None.
 
         Returns:
             np.ndarray: Numpy行列
         """
-        data = self.read_bytes(filepath)
-        return np.frombuffer(data, np.uint8)
+        return np.asarray(self.readinto(filepath, buffer, pool))
+
+    @_instrumented
+    def read_dataframe(self, filepath, sep=',', engine='c', index_col=None, parse_dates=None, chunksize=None,
+                       compression=None, **kwargs):
+        """ストレージ上のCSVファイルをデータフレームとして読み込み
+
+        ダウンロードしたチャンクをbytesのままパーサーへ渡すため、
+        ファイル全体をメモリ上に複製しない。
+
+        Args:
+            filepath (str): ファイルのパス
+            sep (str, optional): 区切り文字. Defaults to ','.
+            engine (str, optional): pandasのパーサー(c, pyarrow, python). Defaults to 'c'.
+            index_col (optional): インデックス列. Defaults to None.
+            parse_dates (optional): 日付として読み込む列. Defaults to None.
+            chunksize (int, optional): 指定した場合はchunksize行毎のデータフレームを返す
+                イテレーターを返し、ダウンロード中から処理できる. Defaults to None.
+            compression (str, optional): 圧縮形式(gzip, zstd, infer). Defaults to None.
+            **kwargs: pd.read_csvへ渡す追加の引数
+
+        Returns:
+            pd.DataFrame: pandasデータフレーム (chunksize指定時はイテレーター)
+        """
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        compression = _resolve_compression(compression, filepath)
+        local = self._journal_read(filepath)
+        if local is not None:
+            chunks = [local] if compression is None else _decompress_chunks([local], compression)
+            source = io.BufferedReader(_ChunkReader(chunks))
+        elif compression is not None:
+            source = io.BufferedReader(_ChunkReader(self._iter_chunks(file_client, compression)))
+        elif self.cache is None:
+            source = io.BufferedReader(_ChunkReader(file_client.download_file().chunks()))
+        else:
+            # pandas opens the path right away, so an entry evicted in between is downloaded again
+            return self._with_cached_file(file_client, lambda path: pd.read_csv(
+                path, sep=sep, engine=engine, index_col=index_col, parse_dates=parse_dates,
+                chunksize=chunksize, **kwargs))
+        return pd.read_csv(source, sep=sep, engine=engine, index_col=index_col,
+                           parse_dates=parse_dates, chunksize=chunksize, **kwargs)
 
-    def read_dataframe(self, filepath, sep=',', engine='python', index_col=None, parse_dates=None) -> pd.DataFrame:
-        data = self.read_bytes(filepath)
-        if isinstance(data, (bytes, bytearray)):
-            data = data.decode()
+    @_instrumented
+    def iter_query_csv(self, sql_query: str, filepath: str, batch_size: int = None, file_format: str = "csv"):
+        """CSVファイルにクエリを実行し、結果を受信しながら1レコードずつ返す
 
-        return pd.read_csv(StringIO(data), sep=sep, engine=engine, index_col=index_col, parse_dates=parse_dates)
+        Args:
+            sql_query (str or Expr): クエリ文字列、またはWHERE句の条件式
+            filepath (str): ファイルのパス
+            batch_size (int, optional): 指定した場合はbatch_size行毎のデータフレームを返す.
+                Defaults to None.
+            file_format (str, optional): 対象ファイルの形式(csv, json). jsonは1行1レコード.
+                Defaults to "csv".
 
-    def query_csv(self, sql_query: str, filepath: str):
+        Yields:
+            dict: レコード (batch_size指定時はpd.DataFrame)
+        """
+        if isinstance(sql_query, Expr):
+            sql_query = select(sql_query)
+        self._journal_wait(filepath)
         file_client = self.container.get_file_client(
             filepath.replace(os.sep, "/"))
 
-        # setup formatter
-        input_format = DelimitedTextDialect(
-            delimiter=',', quotechar='"', escapechar="", has_header=True)
-        output_format = DelimitedJsonDialect(delimiter=',')
+        records = _query_records(file_client, sql_query, file_format)
+        if batch_size is None:
+            yield from records
+            return
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            yield pd.DataFrame.from_records(batch)
+
+    @_instrumented
+    def query_csv(self, sql_query: str, filepath: str, file_format: str = "csv"):
+        """CSVファイルにクエリを実行し、結果をレコードのリストで返す
+
+        result_cacheがある場合は(パス, ETag, 正規化したSQL)で結果をキャッシュし、
+        ファイルが変わっていなければプロパティの取得のみで返す。この場合のリストは
+        キャッシュと共有するため、変更する場合はコピーすること。
 
-        # query the data, then convert it to json object
+        Args:
+            sql_query (str or Expr): クエリ文字列、またはWHERE句の条件式
+            filepath (str): ファイルのパス
+            file_format (str, optional): 対象ファイルの形式(csv, json). Defaults to "csv".
+
+        Returns:
+            list: レコード(dict)のリスト
+        """
+        if self.result_cache is None:
+            return list(self.iter_query_csv(sql_query, filepath, file_format=file_format))
+
+        if isinstance(sql_query, Expr):
+            sql_query = select(sql_query)
+        self._journal_wait(filepath)
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+        etag = file_client.get_file_properties()['etag']
+        # the format is part of the key, the same text means something else as json
+        sql = "{}:{}".format(file_format, sql_query)
+        records = self.result_cache.get(file_client.url, etag, sql)
+        if records is None:
+            # query the version the etag belongs to, so a newer file is never cached under it
+            records = list(_query_records(file_client, sql_query, file_format,
+                                          etag=etag, match_condition=MatchConditions.IfNotModified))
+            self.result_cache.put(file_client.url, etag, sql, records)
+        return records
+
+    @_instrumented
+    def iter_query_partitions(self, path_template: str, start, end, column: str = None, sql_query: str = None,
+                              freq: str = "D", max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                              file_format: str = "csv"):
+        """日付で分割されたファイル群に並列でクエリを実行し、結果を受信順に返す
+
+        path_templateの{date}を期間内のパーティション(freq毎)で置き換えたファイルのみを
+        対象とし、存在しないファイルは除外する。ファイル毎のクエリは最大max_concurrency本を
+        同時に実行し、完了したファイルから順にレコードを返す。
+
+        Args:
+            path_template (str): ファイルパスのテンプレート. 例: "logs/{date:%Y/%m/%d}.csv"
+            start (datetime): 期間の開始. タイムゾーンが無い場合はUTCとみなす
+            end (datetime): 期間の終了日 (当日を含む). 時刻は無視する
+            column (str, optional): 期間で絞り込むタイムスタンプ列. sql_query未指定時に使用する.
+                Defaults to None.
+            sql_query (str, optional): 各ファイルに実行するクエリ. Defaults to None
+                (columnがあればtimestamp_between、無ければ全件).
+            freq (str, optional): パーティションの単位 (pandasの頻度文字列). Defaults to "D".
+            max_concurrency (int, optional): 同時実行数. Defaults to DEFAULT_MAX_CONCURRENCY.
+            file_format (str, optional): 対象ファイルの形式(csv, json). Defaults to "csv".
+
+        Yields:
+            dict: レコード
+        """
+        # timestamp_between matches up to end + 1 day, so end is a whole day for the filter and the pruning alike
+        start, end = _as_utc(start), _as_utc(end).normalize()
+        if sql_query is None:
+            sql_query = QueryBuilder(column).timestamp_between(start, end) if column is not None else QueryBuilder()
+
+        # prune partitions outside of the time range, then the ones that do not exist
+        partitions = pd.date_range(start.floor(freq), end + timedelta(days=1), freq=freq, inclusive="left")
+        filepaths = list(dict.fromkeys(path_template.format(date=date) for date in partitions))
+        exists = self.exists_many(filepaths)
+        pending = iter([filepath for filepath in filepaths if exists[filepath]])
+
+        # keep at most max_concurrency files in flight and stream results as they complete
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            context = contextvars.copy_context()
+            futures = {executor.submit(context.copy().run, self.query_csv, sql_query, filepath, file_format)
+                       for filepath in itertools.islice(pending, max_concurrency)}
+            try:
+                while futures:
+                    future = next(as_completed(futures))
+                    futures.remove(future)
+                    for filepath in itertools.islice(pending, 1):
+                        futures.add(executor.submit(context.copy().run, self.query_csv, sql_query, filepath, file_format))
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    @_instrumented
+    def query_arrow(self, sql_query: str, filepath: str, schema, file_format: str = "csv", as_pandas: bool = True):
+        """ファイルにクエリを実行し、結果をArrow形式で受け取る
+
+        サービス側で型変換したArrowストリームを受け取るため、JSONの解析が不要になる。
+
+        Args:
+            sql_query (str or Expr): クエリ文字列、またはWHERE句の条件式
+            filepath (str): ファイルのパス
+            schema (dict or list): 列名をキー、ArrowTypeまたはその値('int64', 'double',
+                'timestamp[ms]'など)を値とするdict、またはArrowDialectのリスト
+            file_format (str, optional): 対象ファイルの形式(csv, json). Defaults to "csv".
+            as_pandas (bool, optional): TRUEはpd.DataFrame、FALSEはpyarrow.Tableを返す.
+                Defaults to True.
+
+        Returns:
+            pd.DataFrame: クエリ結果 (as_pandasがFALSEの場合はpyarrow.Table)
+        """
+        import pyarrow as pa
+
+        if isinstance(schema, dict):
+            output_format = [ArrowDialect(ArrowType(arrow_type), name=name)
+                             for name, arrow_type in schema.items()]
+        else:
+            output_format = list(schema)
+
+        if isinstance(sql_query, Expr):
+            sql_query = select(sql_query)
+        self._journal_wait(filepath)
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
         reader = file_client.query_file(
-            sql_query, file_format=input_format, output_format=output_format)
-        content = reader.readall()
-        content = json.loads('[{0}]'.format(content.decode()[:-1]))
-        return content
+            sql_query, file_format=_input_dialect(file_format), output_format=output_format)
+        table = pa.ipc.open_stream(reader.readall()).read_all()
+        return table.to_pandas() if as_pandas else table
 
-    def __normalize_timestamp__(self, df: pd.DataFrame) -> pd.DataFrame:
-        dt_columns = df.select_dtypes('datetimetz')
-        if len(dt_columns):
-            df[dt_columns.columns] = dt_columns.apply(
-                lambda x: x.dt.tz_convert('utc'))
-            df[dt_columns.columns] = dt_columns.apply(
-                lambda x: x.dt.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
-
-        dt_columns = df.select_dtypes('datetime64')
-        if len(dt_columns):
-            df[dt_columns.columns] = dt_columns.apply(
-                lambda x: pd.to_datetime(x, utc=True))
-            df[dt_columns.columns] = dt_columns.apply(
-                lambda x: x.dt.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
-        return df
+    @_instrumented
+    def query(self, sql_query, filepath: str, file_format: str = "csv", output: str = "arrow", local: bool = None):
+        """ファイルにクエリを実行し、結果をArrowまたはNumPyで返す
+
+        ファイルが読み込みキャッシュにある場合、またはキャッシュが有効でファイルサイズが
+        local_query_max_bytes以下の場合は、キャッシュしたコピーにDuckDBで実行するため、
+        2回目以降はネットワークを使わない (ETagの確認のみ)。それ以外はストレージの
+        クイッククエリで実行する。列の型はどちらの場合も値から推定する。
 
+        Args:
+            sql_query (str or Expr): QueryBuilderなどで作ったクエリ文字列、またはWHERE句の条件式
+            filepath (str): ファイルのパス
+            file_format (str, optional): 対象ファイルの形式(csv, json, parquet). Defaults to "csv".
+            output (str, optional): 結果の形式(arrow, numpy, pandas). Defaults to "arrow".
+            local (bool, optional): TRUEはローカル、FALSEはストレージで実行する. Defaults to None
+                (キャッシュの有無とファイルサイズで選ぶ).
+
+        Returns:
+            pyarrow.Table: クエリ結果 (numpyは列名をキーとするnp.ndarrayのdict、pandasはpd.DataFrame)
+        """
+        self._journal_wait(filepath)
+        file_client = self.container.get_file_client(
+            filepath.replace(os.sep, "/"))
+
+        source = self._local_query_file(file_client, local)
+        if source is not None:
+            engine = self._local_engine
+            try:
+                with _phase("local_query"):
+                    return engine.execute(sql_query, source, file_format,
+                                          _resolve_compression("infer", filepath), output)
+            except engine.Error:
+                # e.g. SQL the DuckDB parser rejects, the storage may still accept it
+                if local:
+                    raise
+
+        if isinstance(sql_query, Expr):
+            sql_query = select(sql_query)
+        output_format = DelimitedTextDialect(delimiter=',', quotechar='"', lineterminator='\n',
+                                             escapechar="", has_header=True)
+        reader = file_client.query_file(
+            sql_query, file_format=_input_dialect(file_format), output_format=output_format)
+        return to_output(read_csv_result(reader.readall()), output)
+
+    def _local_query_file(self, file_client, local) -> str:
+        # cached copy to run query() on, None to run it on the storage
+        if local is False:
+            return None
+        if self.cache is None:
+            if local:
+                raise ValueError("local query execution needs cache_dir")
+            return None
+        if self._local_engine is None:
+            try:
+                self._local_engine = LocalQueryEngine()
+            except ImportError:
+                if local:
+                    raise
+                return None
+
+        properties = file_client.get_file_properties()
+        if not local and properties['size'] > self.local_query_max_bytes:
+            # large files run locally only when a copy is already cached
+            return self.cache.lookup(file_client.url, properties['etag'])
+        return self._cached_file(file_client, properties['etag'])
+
+    def _with_cached_file(self, file_client, use, etag: str = None, deadline: float = None):
+        # another process sharing the cache directory can evict the entry between get_file and
+        # use(path) opening it; getting the entry again downloads a fresh copy
+        for attempt in range(_CACHE_ENTRY_ATTEMPTS):
+            path = self._cached_file(file_client, etag, deadline)
+            try:
+                return use(path)
+            except FileNotFoundError:
+                if attempt == _CACHE_ENTRY_ATTEMPTS - 1:
+                    raise
+
+    def _open_cached(self, file_client, etag: str = None, deadline: float = None):
+        # an open file stays readable on POSIX even if the entry is evicted afterwards
+        return self._with_cached_file(file_client, lambda path: open(path, "rb"), etag, deadline)
+
+    def _cached_file(self, file_client, etag: str = None, deadline: float = None) -> str:
+        # revalidate with a properties request, download only on a miss
+        expires = None if deadline is None else time.monotonic() + deadline
+        if etag is None:
+            etag = self._read(lambda: file_client.get_file_properties()['etag'], deadline, "revalidate")
+
+        def download(stream):
+            if self.read_policy is None and expires is None:
+                with _phase("download"):
+                    file_client.download_file(
+                        etag=etag, match_condition=MatchConditions.IfNotModified).readinto(stream)
+                return
+            # attempts of the policy may run concurrently, so each one reads into its own buffer
+            remaining = None if expires is None else max(expires - time.monotonic(), 0.0)
+            stream.write(self._read(lambda: file_client.download_file(
+                etag=etag, match_condition=MatchConditions.IfNotModified).readall(), remaining))
+
+        return self.cache.get_file(file_client.url, etag, download)
+
+    def __normalize_timestamp__(self, df: pd.DataFrame) -> pd.DataFrame:
+        return _normalize_timestamp(df)
 
 '''
 def query_video_analyzer_room_time_range(client, filename, start, end=None):
@@ -227,40 +1636,65 @@ class QueryBuilder(str):
             value = "SELECT * FROM BlobStorage"
         return super().__new__(cls, value)
 
+    def template(self, method: str, selected_vars="*") -> "QueryTemplate":
+        """値だけを差し替えて繰り返し使うクエリのテンプレートを取得する
+
+        Args:
+            method (str): メソッド名 (gt, lt, ge, le, between, isin, contains,
+                timestamp_after, timestamp_before, timestamp_between)
+            selected_vars (optional): 選択する列. Defaults to "*".
+
+        Returns:
+            QueryTemplate: 同じ列・メソッド・選択列に対して共有されるテンプレート
+        """
+        return _query_template(str(self), method, "*" if isinstance(selected_vars, str) else tuple(selected_vars))
+
     def timestamp_between(self, start, end, selected_vars="*"):
+        return self.template("timestamp_between", selected_vars)(start, end)
+
+    def _render_timestamp_between(self, start, end, selected_vars="*"):
         # filter condition
         after = self.__to_timestamp(start)
-        before = end + datetime.timedelta(days=1)
+        before = end + timedelta(days=1)
         before = self.__to_timestamp(before)
 
         # build SQL query expression
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
-            (table[self.__as_timestamp()] > Field(after)) &
-            (table[self.__as_timestamp()] < Field(before))
+            (self.__as_timestamp(table) > Field(after)) &
+            (self.__as_timestamp(table) < Field(before))
         ).get_sql()
         return self.__parse_str(query)
 
     def timestamp_after(self, after, selected_vars="*"):
+        return self.template("timestamp_after", selected_vars)(after)
+
+    def _render_timestamp_after(self, after, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         after = self.__to_timestamp(after)
         query = Query.from_(table).select(*selected_vars).where(
-            table[self.__as_timestamp()] > Field(after)
+            self.__as_timestamp(table) > Field(after)
         ).get_sql()
         return self.__parse_str(query)
 
     def timestamp_before(self, before, selected_vars="*"):
+        return self.template("timestamp_before", selected_vars)(before)
+
+    def _render_timestamp_before(self, before, selected_vars="*"):
         table = pTable("BlobStorage")
         before = self.__to_timestamp(before)
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
-            table[self.__as_timestamp()] < Field(before)
+            self.__as_timestamp(table) < Field(before)
         ).get_sql()
         return self.__parse_str(query)
 
     def between(self, lower, upper, selected_vars="*"):
+        return self.template("between", selected_vars)(lower, upper)
+
+    def _render_between(self, lower, upper, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -270,6 +1704,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def gt(self, value, selected_vars="*"):
+        return self.template("gt", selected_vars)(value)
+
+    def _render_gt(self, value, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -278,6 +1715,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def lt(self, value, selected_vars="*"):
+        return self.template("lt", selected_vars)(value)
+
+    def _render_lt(self, value, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -286,6 +1726,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def ge(self, value, selected_vars="*"):
+        return self.template("ge", selected_vars)(value)
+
+    def _render_ge(self, value, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -294,6 +1737,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def le(self, value, selected_vars="*"):
+        return self.template("le", selected_vars)(value)
+
+    def _render_le(self, value, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -302,6 +1748,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def isin(self, having, selected_vars="*"):
+        return self.template("isin", selected_vars)(having)
+
+    def _render_isin(self, having, selected_vars="*"):
         table = pTable('BlobStorage')
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -310,6 +1759,9 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def contains(self, contain_list, selected_vars="*"):
+        return self.template("contains", selected_vars)(contain_list)
+
+    def _render_contains(self, contain_list, selected_vars="*"):
         table = pTable("BlobStorage")
         selected_vars = self.__parse_select_vars(selected_vars)
         query = Query.from_(table).select(*selected_vars).where(
@@ -344,38 +1796,30 @@ class QueryBuilder(str):
         return self.__parse_str(query)
 
     def all(self, condition_list, selected_vars="*"):
-        table = pTable("BlobStorage")
-        locs = locals()
-        selected_vars = self.__parse_select_vars(selected_vars)
-        query = Query.from_(table).select(*selected_vars).where(
-            Criterion.all([
-                eval(condition, locs) for condition in condition_list
-            ])
-        ).get_sql()
-        query = self.__parse_timestamp(query)
-        return self.__parse_str(query)
+        """条件を全て満たす行を選択するクエリを作成する
+
+        Args:
+            condition_list (list): 条件のリスト. col()で作った式、または"table['x'] > 5"形式の文字列
+            selected_vars (optional): 選択する列のリスト. Defaults to "*".
+
+        Returns:
+            str: クエリ文字列
+        """
+        conditions = [as_condition(condition) for condition in condition_list]
+        return select(And(*conditions) if conditions else None, selected_vars)
 
     def any(self, condition_list, selected_vars="*"):
-        table = pTable("BlobStorage")
-        locs = locals()
-        selected_vars = self.__parse_select_vars(selected_vars)
-        query = Query.from_(table).select(*selected_vars).where(
-            Criterion.any([
-                eval(condition, locs) for condition in condition_list
-            ])
-        ).get_sql()
-        query = self.__parse_timestamp(query)
-        return self.__parse_str(query)
+        """条件のいずれかを満たす行を選択するクエリを作成する
 
-    def __parse_timestamp(self, expr):
-        regex = re.compile(r'[0-9]*-[0-9][0-9]-[0-9][0-9]', re.S)
-        expr = regex.sub(lambda m: pd.to_datetime(m.group()).strftime(
-            "TO_TIMESTAMP(\'%Y-%m-%dT%H:%M:%S+00:00\')"), expr)
-        regex = re.compile(r'\'TO_TIMESTAMP', re.S)
-        expr = regex.sub(lambda m: m.group().replace(
-            '\'TO_TIMESTAMP', "TO_TIMESTAMP"), expr)
-        expr = re.sub(r'\)\'', ")", expr)
-        return expr
+        Args:
+            condition_list (list): 条件のリスト. col()で作った式、または"table['x'] > 5"形式の文字列
+            selected_vars (optional): 選択する列のリスト. Defaults to "*".
+
+        Returns:
+            str: クエリ文字列
+        """
+        conditions = [as_condition(condition) for condition in condition_list]
+        return select(Or(*conditions) if conditions else None, selected_vars)
 
     def __parse_select_vars(self, selected_vars):
         if not isinstance(selected_vars, str):
@@ -385,26 +1829,184 @@ class QueryBuilder(str):
         return selected_vars
 
     def __to_timestamp(self, datetime, timezone="+00:00"):
-        # if timezone information is not specified, it is assumed to be UTC
-        if datetime.tzinfo is None:
-            return "TO_TIMESTAMP('{0}{1}')".format(datetime.isoformat(), timezone)
-        else:
-            return "TO_TIMESTAMP('{}')".format(datetime.isoformat())
+        return _to_timestamp(datetime, timezone)
 
-    def __as_timestamp(self):
-        return "CAST(\"{0}\" AS TIMESTAMP)".format(self)
+    def __as_timestamp(self, table):
+        # a Cast term, so pypika quotes only the column: CAST("create_time" AS TIMESTAMP)
+        return Cast(table[self], "TIMESTAMP")
 
     def __parse_str(self, sql_expr):
-        regex = re.compile('"[A-Z_]*\(', re.S)
-        sql_expr = regex.sub(lambda m: m.group().replace('"', ""), sql_expr)
-        regex = re.compile('[A-Z]*\)"', re.S)
-        sql_expr = regex.sub(lambda m: m.group().replace('"', ""), sql_expr)
-
-        regex = re.compile('[A-Z][A-Z]*\"', re.S)
-        sql_expr = regex.sub(lambda m: m.group().replace('"', ""), sql_expr)
-
-        # SELECT "*" -> SELECT *
-        regex = re.compile('"\*"', re.S)
-        sql_expr = regex.sub(lambda m: m.group().replace('"*"', "*"), sql_expr)
-
-        return sql_expr
+        return _parse_str(sql_expr)
+
+
+# rewrites applied to the SQL rendered by pypika, compiled once
+_UNQUOTE_FUNCTION = re.compile(r'"([A-Z_]*\()', re.S)
+_UNQUOTE_CLOSE = re.compile(r'([A-Z]*\))"', re.S)
+_UNQUOTE_UPPER = re.compile(r'([A-Z][A-Z]*)"', re.S)
+_QUOTED_STAR = re.compile(r'"\*"', re.S)
+
+
+def _parse_str(sql_expr: str) -> str:
+    sql_expr = _UNQUOTE_FUNCTION.sub(r"\1", sql_expr)
+    sql_expr = _UNQUOTE_CLOSE.sub(r"\1", sql_expr)
+    sql_expr = _UNQUOTE_UPPER.sub(r"\1", sql_expr)
+    # SELECT "*" -> SELECT *
+    return _QUOTED_STAR.sub("*", sql_expr)
+
+
+def _to_timestamp(value, timezone="+00:00") -> str:
+    # if timezone information is not specified, it is assumed to be UTC
+    if value.tzinfo is None:
+        return "TO_TIMESTAMP('{0}{1}')".format(value.isoformat(), timezone)
+    return "TO_TIMESTAMP('{}')".format(value.isoformat())
+
+
+def _is_simple(value) -> bool:
+    # values pypika renders through ValueWrapper (lists, tuples and terms render differently)
+    return not isinstance(value, (Node, list, tuple))
+
+
+def _sql_literal(value) -> str:
+    """Render a value like pypika's ValueWrapper with "'" as the string quote."""
+    if isinstance(value, Enum):
+        return _sql_literal(value.value)
+    if isinstance(value, (date, datetime, datetime_time)):
+        value = value.isoformat()
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, uuid.UUID):
+        return _sql_literal(str(value))
+    if value is None:
+        return "null"
+    return str(value)
+
+
+def _bound_literal(value) -> str:
+    literal = _sql_literal(value)
+    # a literal never shares a rewrite with the text around it, so rewriting it alone is exact
+    return _parse_str(literal) if '"' in literal else literal
+
+
+# sentinels rendered in place of the values when a template is compiled
+_SENTINELS = ("\x00qt0\x00", "\x00qt1\x00")
+_TIMESTAMP_SENTINELS = (datetime(1901, 2, 3, 4, 5, 6), datetime(1902, 3, 4, 5, 6, 7))
+_TEMPLATE_METHODS = {
+    "gt": "value", "lt": "value", "ge": "value", "le": "value", "between": "value",
+    "isin": "isin", "contains": "contains",
+    "timestamp_after": "timestamp", "timestamp_before": "timestamp", "timestamp_between": "timestamp",
+}
+
+
+class QueryTemplate():
+    """値だけを差し替えて繰り返し使うQueryBuilderのクエリ
+
+    作成時にpypikaで組み立てたSQLを値の位置で分割しておき、呼び出し時は値のリテラルを
+    埋め込むだけで、QueryBuilderの同名メソッドと同じ文字列を返す。pypikaの項やリストなど
+    埋め込めない値は、従来通りpypikaで組み立てる。
+
+    gt = QueryBuilder("room_id").template("gt")
+    gt(5)  # == QueryBuilder("room_id").gt(5)
+
+    Args:
+        column (str): 列名
+        method (str): QueryBuilderのメソッド名
+        selected_vars (optional): 選択する列. Defaults to "*".
+    """
+
+    def __init__(self, column: str, method: str, selected_vars="*"):
+        kind = _TEMPLATE_METHODS.get(method)
+        if kind is None:
+            raise ValueError("no template for QueryBuilder.{}".format(method))
+        self.column = column
+        self.method = method
+        self.selected_vars = selected_vars
+        self._render = getattr(QueryBuilder(column), "_render_" + method)
+        self._parts = None
+
+        # a shape that does not split cleanly around the sentinels always renders through pypika
+        if kind == "value":
+            count = 2 if method == "between" else 1
+            sql = self._render(*_SENTINELS[:count], selected_vars=selected_vars)
+            self._parts = _split(sql, [_sql_literal(sentinel) for sentinel in _SENTINELS[:count]])
+            self._bind = self._bind_values
+        elif kind == "timestamp":
+            count = 2 if method == "timestamp_between" else 1
+            sql = self._render(*_TIMESTAMP_SENTINELS[:count], selected_vars=selected_vars)
+            stamps = list(_TIMESTAMP_SENTINELS[:count])
+            if method == "timestamp_between":
+                stamps[1] += timedelta(days=1)
+            self._parts = _split(sql, [_to_timestamp(stamp) for stamp in stamps])
+            self._bind = self._bind_timestamps
+        elif kind == "isin":
+            sql = self._render([_SENTINELS[0]], selected_vars=selected_vars)
+            self._parts = _split(sql, [_sql_literal(_SENTINELS[0])])
+            self._bind = self._bind_isin
+        else:
+            sql = self._render(list(_SENTINELS), selected_vars=selected_vars)
+            parts = _split(sql, [_sql_literal(sentinel) for sentinel in _SENTINELS])
+            if parts is not None and parts[1].startswith(" OR ") and parts[0].endswith(parts[1][4:]) \
+                    and not parts[2]:
+                term = parts[1][4:]
+                self._parts = (parts[0][:len(parts[0]) - len(term)], term)
+            self._bind = self._bind_contains
+
+    def __call__(self, *values) -> str:
+        if self._parts is not None:
+            sql = self._bind(*values)
+            if sql is not None:
+                return sql
+        return self._render(*values, selected_vars=self.selected_vars)
+
+    def _bind_values(self, *values):
+        if not all(_is_simple(value) for value in values):
+            return None
+        parts = self._parts
+        if len(values) == 1:
+            return parts[0] + _bound_literal(values[0]) + parts[1]
+        return parts[0] + _bound_literal(values[0]) + parts[1] + _bound_literal(values[1]) + parts[2]
+
+    def _bind_timestamps(self, *values):
+        if not all(isinstance(value, datetime) for value in values):
+            return None
+        if self.method == "timestamp_between":
+            values = (values[0], values[1] + timedelta(days=1))
+        sql = self._parts[0]
+        for value, part in zip(values, self._parts[1:]):
+            sql += _to_timestamp(value) + part
+        return sql
+
+    def _bind_isin(self, having):
+        if not isinstance(having, (list, tuple, set)) or not all(_is_simple(value) for value in having):
+            return None
+        return self._parts[0] + ",".join(_bound_literal(value) for value in having) + self._parts[1]
+
+    def _bind_contains(self, contain_list):
+        # contains() splits the rendered list on "," and stops at the first "]"
+        if not isinstance(contain_list, list) or not all(_is_simple(value) for value in contain_list):
+            return None
+        values = ",".join(_sql_literal(value) for value in contain_list)
+        end = values.find("]")
+        if end >= 0:
+            values = values[:end]
+        head, term = self._parts
+        return head + " OR ".join(term + (_parse_str(item) if '"' in item else item)
+                                  for item in values.split(","))
+
+
+def _split(sql: str, markers: list):
+    # split sql around each marker in order, None when a marker is missing or repeated
+    parts = []
+    for marker in markers:
+        if sql.count(marker) != 1:
+            return None
+        before, sql = sql.split(marker)
+        parts.append(before)
+    parts.append(sql)
+    return parts
+
+
+@functools.lru_cache(maxsize=1024)
+def _query_template(column: str, method: str, selected_vars) -> QueryTemplate:
+    return QueryTemplate(column, method, selected_vars)
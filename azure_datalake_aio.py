@@ -0,0 +1,166 @@
+import os
+import asyncio
+import pandas as pd
+from azure.storage.filedatalake.aio import DataLakeServiceClient
+from azure_datalake import AzureDatalakeV2, DEFAULT_BATCH_ROWS, _csv_blocks
+
+# number of transfers running at once in read_many/write_many
+DEFAULT_BULK_CONCURRENCY = 64
+
+
+class AsyncAzureDatalakeV2():
+    """AzureDatalakeV2のasyncio版
+
+    async with AsyncAzureDatalakeV2(...) as client: の形で使用する。
+    """
+
+    def __init__(self, account_name: str = None, account_key: str = None, container_name: str = None, conn_str: str = None):
+        self.account_name = account_name
+        self.account_key = account_key
+        self.container_name = container_name
+        self.conn_str = conn_str
+        self._sync = None
+        if conn_str is not None:
+            self.conn = DataLakeServiceClient.from_connection_string(
+                conn_str=conn_str)
+        else:
+            self.conn = DataLakeServiceClient(
+                account_url=f"https://{account_name}.dfs.core.windows.net",
+                credential=account_key
+            )
+        self.container = self.conn.get_file_system_client(container_name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.conn.close()
+        # the sync client comes from the shared registry and stays open
+        self._sync = None
+
+    async def blob_exists(self, filepath: str) -> bool:
+        """指定したファイルが存在するか確認する
+
+        Args:
+            filepath (str): ファイルパス
+
+        Returns:
+            bool: 存在する場合はTRUE、しない場合はFALSE
+        """
+        file_client = self.container.get_file_client(filepath.replace(os.sep, "/"))
+        return await file_client.exists()
+
+    async def write_bytes(self, outfile: str, memstring, metadata=None):
+        """文字列データをストレージにアップロードする
+
+        Args:
+            outfile (str): ストレージのパス
+            memstring (str): 文字列データ
+            metadata (_type_, optional): メタデータ. Defaults to None.
+
+        Returns:
+            _type_: ストレージのヘッダー情報
+        """
+        file_client = self.container.get_file_client(outfile.replace(os.sep, "/"))
+        await file_client.create_file(metadata=metadata)
+        data = memstring.encode("utf-8") if isinstance(memstring, str) else memstring
+        await file_client.append_data(data=data, offset=0, length=len(data))
+        return await file_client.flush_data(len(data))
+
+    async def write_dataframe(self, filepath: str, data: pd.DataFrame, append=False,
+                              batch_size: int = DEFAULT_BATCH_ROWS):
+        """Pandasデータフレームをストレージにアップロードする
+
+        CSVへの変換はイベントループを塞がないようにワーカースレッドで行う。
+
+        Args:
+            filepath (str): ストレージのパス
+            data (pd.DataFrame): pandasデータフレーム
+            append (bool, optional): TRUEは追記、FALSEは書き込み. デファクトはFALSE
+            batch_size (int, optional): 1回のappendで送る行数. Defaults to DEFAULT_BATCH_ROWS.
+
+        Returns:
+            _type_: ストレージのヘッダー情報
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+
+        file_client = self.container.get_file_client(filepath.replace(os.sep, "/"))
+        if append:
+            offset = (await file_client.get_file_properties())['size']
+        else:
+            await file_client.create_file()
+            offset = 0
+
+        blocks = _csv_blocks(data, header=not append, batch_size=batch_size)
+        while True:
+            block = await asyncio.to_thread(next, blocks, None)
+            if block is None:
+                break
+            await file_client.append_data(block, offset=offset, length=len(block))
+            offset += len(block)
+        return await file_client.flush_data(offset)
+
+    async def read_bytes(self, filepath: str) -> bytes:
+        """ストレージ上のファイルをダウンロード
+
+        Args:
+            filepath (str): ファイルのパス
+
+        Returns:
+            bytes: バイナリデータ
+        """
+        file_client = self.container.get_file_client(filepath.replace(os.sep, "/"))
+        downloader = await file_client.download_file()
+        return await downloader.readall()
+
+    async def query_csv(self, sql_query: str, filepath: str):
+        # the aio SDK has no quick query, so run the sync client in a worker thread
+        if self._sync is None:
+            self._sync = AzureDatalakeV2(self.account_name, self.account_key,
+                                         self.container_name, self.conn_str)
+        return await asyncio.to_thread(self._sync.query_csv, sql_query, filepath)
+
+    async def read_many(self, filepaths, concurrency: int = DEFAULT_BULK_CONCURRENCY) -> list:
+        """複数のファイルを同時にダウンロードする
+
+        Args:
+            filepaths (list): ファイルパスのリスト
+            concurrency (int, optional): 同時実行数. Defaults to DEFAULT_BULK_CONCURRENCY.
+
+        Returns:
+            list: filepathsと同じ順序のバイナリデータのリスト
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def read(filepath):
+            async with semaphore:
+                return await self.read_bytes(filepath)
+
+        return await asyncio.gather(*[read(filepath) for filepath in filepaths])
+
+    async def write_many(self, items, concurrency: int = DEFAULT_BULK_CONCURRENCY) -> list:
+        """複数のファイルを同時にアップロードする
+
+        Args:
+            items (iterable): (ストレージのパス, データ)のリストまたはdict.
+                データがpd.DataFrameの場合はwrite_dataframe、それ以外はwrite_bytesで書き込む
+            concurrency (int, optional): 同時実行数. Defaults to DEFAULT_BULK_CONCURRENCY.
+
+        Returns:
+            list: ストレージのヘッダー情報のリスト
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def write(outfile, data):
+            async with semaphore:
+                if isinstance(data, pd.DataFrame):
+                    return await self.write_dataframe(outfile, data)
+                return await self.write_bytes(outfile, data)
+
+        return await asyncio.gather(*[write(outfile, data) for outfile, data in items])
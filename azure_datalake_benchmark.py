@@ -0,0 +1,499 @@
+"""Benchmark AzureDatalakeV2 against an in-process fake of DataLakeServiceClient.
+
+The fake keeps files in memory and can inject per-request latency, a bandwidth
+limit, occasional slow responses and transient errors, so changes to azure_datalake.py can be
+measured without a storage account.
+
+    python azure_datalake_benchmark.py --output bench.json
+    python azure_datalake_benchmark.py --latency 0.02 --bandwidth 50e6 --baseline bench.json
+    python azure_datalake_benchmark.py --latency 0.005 --slow-rate 0.02 --slow-latency 0.2 --hedge
+    python azure_datalake_benchmark.py --query-builder 20000
+"""
+import os
+import io
+import csv
+import json
+import time
+import weakref
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+import numpy as np
+import pandas as pd
+from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError, ServiceResponseError
+from azure.storage.filedatalake import DelimitedTextDialect
+from azure_datalake import AzureDatalakeV2, ReadPolicy, QueryBuilder, ResultCache
+
+# size of the chunks yielded by FakeDownloader.chunks()
+FAKE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class FakeProperties(dict):
+    """FileProperties/PathProperties stand-in supporting both item and attribute access."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeDataLakeServiceClient():
+    """DataLakeServiceClientのうちAzureDatalakeV2が使う部分のインメモリ実装
+
+    Args:
+        latency (float, optional): リクエスト毎の遅延(秒). Defaults to 0.
+        bandwidth (float, optional): 転送速度(byte/秒). Noneは無制限. Defaults to None.
+        slow_rate (float, optional): 遅いレスポンスを返す確率. Defaults to 0.
+        slow_latency (float, optional): 遅いレスポンスに追加する遅延(秒). Defaults to 0.
+        seed (int, optional): slow_rate, error_rateの乱数シード. Defaults to None.
+        error_rate (float, optional): ServiceResponseErrorで失敗する確率. Defaults to 0.
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = None, slow_rate: float = 0.0,
+                 slow_latency: float = 0.0, seed: int = None, error_rate: float = 0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.url = "https://fake.dfs.core.windows.net"
+        self.files = {}
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._file_systems = {}
+
+    def get_file_system_client(self, file_system):
+        with self._lock:
+            if file_system not in self._file_systems:
+                self._file_systems[file_system] = FakeFileSystemClient(self, file_system)
+            return self._file_systems[file_system]
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def _request(self, operation: str, nbytes: int = 0):
+        with self._lock:
+            self.requests[operation] += 1
+            slow = self.slow_rate and self._random.random() < self.slow_rate
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if failed:
+            raise ServiceResponseError("injected connection reset")
+        delay = self.latency + (self.slow_latency if slow else 0.0)
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeFileSystemClient():
+    def __init__(self, service, file_system_name):
+        # like the SDK's clients, no strong reference back to the service client, so that
+        # the registry in get_file_system_client can drop its entry with the service
+        self.service = weakref.proxy(service)
+        self.file_system_name = file_system_name
+        self.url = "{}/{}".format(service.url, file_system_name)
+
+    def get_file_client(self, file_path):
+        return FakeFileClient(self, file_path)
+
+    def get_directory_client(self, directory):
+        return FakeDirectoryClient(self, directory)
+
+    def get_paths(self, path=None, recursive=True, **kwargs):
+        self.service._request("list")
+        prefix = path.strip("/") + "/" if path else ""
+        names = [name for (file_system, name) in self.service.files
+                 if file_system == self.file_system_name and name.startswith(prefix)]
+        if prefix and not names:
+            raise ResourceNotFoundError("The specified path does not exist.")
+        for name in sorted(names):
+            if recursive or "/" not in name[len(prefix):]:
+                yield FakeProperties(name=name, is_directory=False)
+
+
+class FakeDirectoryClient():
+    def __init__(self, file_system, directory):
+        self.file_system = file_system
+        self.path_name = "" if directory in ("", ".", "./") else directory.replace(os.sep, "/").strip("/")
+
+    def get_file_client(self, file):
+        return FakeFileClient(self.file_system, _posix_join(self.path_name, file))
+
+    def create_file(self, file, **kwargs):
+        file_client = self.get_file_client(file)
+        file_client.create_file(**kwargs)
+        return file_client
+
+
+def _posix_join(directory, name):
+    return "{}/{}".format(directory, name) if directory else name
+
+
+class FakeFile():
+    def __init__(self):
+        self.committed = b""
+        self.staged = bytearray()
+        self.version = 0
+
+    @property
+    def etag(self):
+        return '"0x{:08X}"'.format(self.version)
+
+
+class FakeFileClient():
+    def __init__(self, file_system, path):
+        self.file_system = file_system
+        self.service = file_system.service
+        self.file_system_name = file_system.file_system_name
+        self.path_name = path.replace(os.sep, "/").strip("/")
+        self.url = "{}/{}".format(file_system.url, self.path_name)
+        self._key = (self.file_system_name, self.path_name)
+
+    def _file(self) -> FakeFile:
+        try:
+            return self.service.files[self._key]
+        except KeyError:
+            raise ResourceNotFoundError("The specified path does not exist.")
+
+    def exists(self, **kwargs):
+        self.service._request("exists")
+        return self._key in self.service.files
+
+    def create_file(self, **kwargs):
+        self.service._request("create")
+        with self.service._lock:
+            file = self.service.files.setdefault(self._key, FakeFile())
+            file.committed = b""
+            file.staged = bytearray()
+            file.version += 1
+        return {"etag": file.etag}
+
+    def append_data(self, data, offset, length=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read(length) if length is not None else data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        data = bytes(data)
+        if length is not None and length != len(data):
+            raise ValueError("length {} does not match the data ({} bytes)".format(length, len(data)))
+        self.service._request("append", len(data))
+        with self.service._lock:
+            file = self._file()
+            if not file.staged:
+                file.staged = bytearray(file.committed)
+            end = offset + len(data)
+            if len(file.staged) < end:
+                file.staged.extend(b"\0" * (end - len(file.staged)))
+            file.staged[offset:end] = data
+            self.service.bytes_sent += len(data)
+
+    def flush_data(self, offset, **kwargs):
+        self.service._request("flush")
+        with self.service._lock:
+            file = self._file()
+            data = file.staged if file.staged else bytearray(file.committed)
+            if len(data) != offset:
+                raise ValueError("flush position {} does not match the data ({} bytes)".format(offset, len(data)))
+            file.committed = bytes(data)
+            file.staged = bytearray()
+            file.version += 1
+            return {"etag": file.etag}
+
+    def get_file_properties(self, **kwargs):
+        self.service._request("properties")
+        return self._properties(self._file())
+
+    def _properties(self, file):
+        return FakeProperties(name=self.path_name, size=len(file.committed), etag=file.etag)
+
+    def download_file(self, offset=None, length=None, etag=None, match_condition=None, **kwargs):
+        file = self._file()
+        if etag is not None and etag != file.etag:
+            raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+        data = file.committed
+        if offset is not None:
+            data = data[offset:offset + length if length is not None else None]
+        return FakeDownloader(self, data, self._properties(file))
+
+    def query_file(self, query_expression, file_format=None, output_format=None, **kwargs):
+        # the fake does not evaluate SQL, it returns every row of the file
+        text = self._file().committed.decode("utf-8")
+        rows = list(csv.DictReader(io.StringIO(text)))
+        if isinstance(output_format, list):
+            return FakeQueryReader(self.service, _arrow_stream(rows, output_format), None)
+        if isinstance(output_format, DelimitedTextDialect):
+            out = io.StringIO()
+            writer = csv.DictWriter(out, fieldnames=list(rows[0]) if rows else [], lineterminator="\n")
+            if output_format.has_header:
+                writer.writeheader()
+            writer.writerows(rows)
+            return FakeQueryReader(self.service, out.getvalue().encode("utf-8"), b"\n")
+        delimiter = getattr(output_format, "delimiter", "\n")
+        data = "".join(json.dumps(row) + delimiter for row in rows).encode("utf-8")
+        return FakeQueryReader(self.service, data, delimiter.encode("utf-8"))
+
+
+def _arrow_stream(rows, output_format) -> bytes:
+    import pyarrow as pa
+    table = pa.table({
+        dialect.name: pa.array([row[dialect.name] for row in rows]).cast(pa.type_for_alias(dialect.type.value))
+        for dialect in output_format
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class FakeDownloader():
+    def __init__(self, file_client, data, properties):
+        self._service = file_client.service
+        self._data = data
+        self._requested = False
+        self.properties = properties
+        self.size = len(data)
+
+    def _transfer(self, data):
+        self._service._request("download" if not self._requested else "download_chunk", len(data))
+        self._requested = True
+        with self._service._lock:
+            self._service.bytes_received += len(data)
+        return data
+
+    def readall(self):
+        return self._transfer(self._data)
+
+    def chunks(self):
+        if not self._data:
+            self._transfer(b"")
+        for i in range(0, len(self._data), FAKE_CHUNK_SIZE):
+            yield self._transfer(self._data[i:i + FAKE_CHUNK_SIZE])
+
+    def readinto(self, stream):
+        for chunk in self.chunks():
+            stream.write(chunk)
+        return self.size
+
+
+class FakeQueryReader():
+    def __init__(self, service, data, record_delimiter):
+        service._request("query", len(data))
+        self._data = data
+        self.record_delimiter = record_delimiter
+
+    def readall(self):
+        return self._data
+
+    def records(self):
+        for record in self._data.split(self.record_delimiter):
+            if record:
+                yield record
+
+
+def _percentiles(samples):
+    p50, p90, p99 = np.percentile(np.asarray(samples) * 1000.0, [50, 90, 99])
+    return {"p50_ms": round(p50, 3), "p90_ms": round(p90, 3), "p99_ms": round(p99, 3),
+            "mean_ms": round(float(np.mean(samples)) * 1000.0, 3)}
+
+
+def _measure(service, name, param, nbytes, fn, repeat, setup=None):
+    samples = []
+    requests = Counter()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        before = Counter(service.requests)
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+        requests += Counter(service.requests) - before
+    result = {"op": name, "param": param, "bytes": nbytes, "repeat": repeat}
+    result.update(_percentiles(samples))
+    result["throughput_mb_s"] = round(nbytes / np.median(samples) / 1e6, 3) if nbytes else None
+    # average number of requests per call
+    result["requests"] = {op: count / repeat for op, count in sorted(requests.items())}
+    return result
+
+
+def _frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        "create_time": pd.date_range("2024-01-01", periods=rows, freq="s", tz="UTC"),
+        "room_id": np.arange(rows) % 97,
+        "value": np.linspace(0.0, 1.0, rows),
+        "name": ["participant-{}".format(i % 1000) for i in range(rows)],
+    })
+
+
+def run(sizes=(64 * 1024, 1024 * 1024, 16 * 1024 * 1024), rows=(1_000, 100_000), repeat: int = 5,
+        latency: float = 0.0, bandwidth: float = None, slow_rate: float = 0.0, slow_latency: float = 0.0,
+        seed: int = 0, hedge: bool = False) -> list:
+    """ベンチマークを実行し、操作毎の結果をdictのリストで返す
+
+    hedgeがTRUEの場合は既定のReadPolicyで読み込み、小さいファイルの読み込みを多数回計測する。
+    """
+    service = FakeDataLakeServiceClient(latency, bandwidth, slow_rate, slow_latency, seed)
+    client = AzureDatalakeV2(container_name="bench", service_client=service,
+                             read_policy=ReadPolicy() if hedge else None)
+    rng = np.random.default_rng(seed)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            payload = rng.integers(0, 256, size, dtype=np.uint8).tobytes()
+            infile = os.path.join(tmp, "payload.bin")
+            with open(infile, "wb") as f:
+                f.write(payload)
+
+            path = "bench/binary_{}.bin".format(size)
+            results.append(_measure(service, "write_binary", size, size,
+                                    lambda: client.write_binary(path, infile), repeat))
+            results.append(_measure(service, "write_bytes", size, size,
+                                    lambda: client.write_bytes(path, payload), repeat))
+            results.append(_measure(service, "read_bytes", size, size,
+                                    lambda: client.read_bytes(path), repeat))
+
+    # tail latency of small reads, where slow responses dominate the p99
+    path = "bench/small.bin"
+    client.write_bytes(path, b"x" * 4096)
+    results.append(_measure(service, "read_bytes_small", 4096, 4096,
+                            lambda: client.read_bytes(path), max(repeat, 200)))
+
+    for count in rows:
+        df = _frame(count)
+        path = "bench/frame_{}.csv".format(count)
+        client.write_dataframe(path, df)
+        nbytes = len(service.files[("bench", path)].committed)
+
+        results.append(_measure(service, "write_dataframe", count, nbytes,
+                                lambda: client.write_dataframe(path, df), repeat))
+        append_path = "bench/append_{}.csv".format(count)
+        results.append(_measure(service, "write_dataframe_append", count, nbytes,
+                                lambda: client.write_dataframe(append_path, df, append=True), repeat,
+                                setup=lambda: client.write_dataframe(append_path, df.head(0))))
+        results.append(_measure(service, "read_dataframe", count, nbytes,
+                                lambda: client.read_dataframe(path), repeat))
+        results.append(_measure(service, "query_csv", count, nbytes,
+                                lambda: client.query_csv("SELECT * FROM BlobStorage", path), repeat))
+
+    # query() on the storage vs DuckDB over the cached copy, and query_csv with a result cache
+    # (both warmed by the first call)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cached = AzureDatalakeV2(container_name="bench", service_client=service, cache_dir=cache_dir,
+                                 result_cache=ResultCache(os.path.join(cache_dir, "results")))
+        query = QueryBuilder("value").gt(0.5)
+        for count in rows:
+            path = "bench/frame_{}.csv".format(count)
+            nbytes = len(service.files[("bench", path)].committed)
+            results.append(_measure(service, "query_remote", count, nbytes,
+                                    lambda: cached.query(query, path, local=False), repeat))
+            cached.query(query, path)
+            results.append(_measure(service, "query_local", count, nbytes,
+                                    lambda: cached.query(query, path), repeat))
+            cached.query_csv(query, path)
+            results.append(_measure(service, "query_csv_cached", count, nbytes,
+                                    lambda: cached.query_csv(query, path), repeat))
+    return results
+
+
+def run_query_builder(number: int = 20_000) -> list:
+    """QueryBuilderの1クエリあたりの生成時間を、pypikaで毎回組み立てる場合と
+    テンプレートへ値を埋め込む場合で比較する"""
+    start = pd.Timestamp("2024-01-01", tz="UTC")
+    cases = [
+        ("gt", ("room_id",), lambda i: (i,)),
+        ("between", ("value",), lambda i: (i, i + 10)),
+        ("isin", ("name",), lambda i: (["participant-{}".format(i), "participant-{}".format(i + 1)],)),
+        ("contains", ("name",), lambda i: (["%{}%".format(i), "%it's%"],)),
+        ("timestamp_between", ("create_time",), lambda i: (start + pd.Timedelta(minutes=i), start + pd.Timedelta(days=1))),
+    ]
+    results = []
+    for method, (column,), make_args in cases:
+        builder = QueryBuilder(column)
+        args = [make_args(i) for i in range(number)]
+        render = getattr(builder, "_render_" + method)
+        bound = getattr(builder, method)
+        assert all(render(*a) == bound(*a) for a in args[:100])
+
+        timings = {}
+        for name, fn in (("pypika", render), ("template", bound)):
+            started = time.perf_counter()
+            for a in args:
+                fn(*a)
+            timings[name] = (time.perf_counter() - started) / number * 1e6
+        results.append({"op": "query_builder." + method, "param": number,
+                        "pypika_us": round(timings["pypika"], 3), "template_us": round(timings["template"], 3),
+                        "speedup": round(timings["pypika"] / timings["template"], 1)})
+    return results
+
+
+def _environment(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "pandas": pd.__version__,
+            "latency": args.latency, "bandwidth": args.bandwidth,
+            "slow_rate": args.slow_rate, "slow_latency": args.slow_latency, "hedge": args.hedge}
+
+
+def compare(results: list, baseline: list):
+    """baselineに対するp50の比率を表示する (1より大きい場合は遅くなった)"""
+    previous = {(r["op"], r["param"]): r for r in baseline}
+    for result in results:
+        before = previous.get((result["op"], result["param"]))
+        if before is None or not before["p50_ms"]:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"]
+        print("{:<24} {:>10} {:>10.3f} ms -> {:>10.3f} ms  x{:.2f}".format(
+            result["op"], result["param"], before["p50_ms"], result["p50_ms"], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="probability of a slow response")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="seconds added to slow responses")
+    parser.add_argument("--hedge", action="store_true", help="read with the default ReadPolicy")
+    parser.add_argument("--query-builder", type=int, metavar="N",
+                        help="only time N QueryBuilder queries per method, pypika vs template")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="json file of a previous run to compare against")
+    args = parser.parse_args()
+
+    if args.query_builder:
+        for result in run_query_builder(args.query_builder):
+            print("{op:<34} {pypika_us:>9.2f} us -> {template_us:>7.2f} us  x{speedup}".format(**result))
+        return
+
+    results = run(args.sizes, args.rows, args.repeat, args.latency, args.bandwidth,
+                  args.slow_rate, args.slow_latency, hedge=args.hedge)
+    report = {"environment": _environment(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
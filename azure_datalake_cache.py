@@ -0,0 +1,360 @@
+import os
+import re
+import sys
+import glob
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# size limits of ResultCache
+DEFAULT_RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_RESULT_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+
+# first bytes of a ResultCache entry, bumped when the format changes
+_RESULT_MAGIC = b"ADLRC3\n"
+# quoted literals and identifiers are kept as is by normalize_sql
+_SQL_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_SQL_SPACES = re.compile(r"\s+")
+_SQL_OPERATOR_SPACES = re.compile(r" ?([=<>!(),]) ?")
+# column value types stored on disk; others would not come back as the same Python values
+_ARROW_TYPES = {str, int, float, bool}
+# records sampled to estimate the memory size of a result
+_SIZE_SAMPLES = 64
+
+
+class ReadCache():
+    """ETagで検証するローカルディスクキャッシュ
+
+    エントリは `<パスのハッシュ>.<ETagのハッシュ>` というファイル名で保存し、
+    一時ファイルからのos.replaceで書き込むため、同一ホストの複数プロセスから
+    同じディレクトリを共有できる。合計サイズがmax_bytesを超えた場合は
+    最終アクセス(mtime)が古いエントリから削除する。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved}
+
+    def lookup(self, key: str, etag: str):
+        """キャッシュ済みのファイルパスを返す. 無い場合はNone"""
+        entry = self._entry(key, etag)
+        try:
+            # mtime doubles as the LRU access time
+            os.utime(entry)
+            size = os.path.getsize(entry)
+        except OSError:
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+        return entry
+
+    def get_file(self, key: str, etag: str, download) -> str:
+        """キャッシュ済みのファイルパスを返す. 無い場合はdownload(stream)で書き込む
+
+        同じエントリを同時に要求したスレッドはひとつのダウンロードを共有する。
+
+        Args:
+            key (str): キャッシュキー (ストレージのパス)
+            etag (str): ファイルのETag
+            download (callable): 書き込み先のストリームを受け取りダウンロードする関数
+
+        Returns:
+            str: ローカルファイルのパス
+        """
+        entry = self.lookup(key, etag)
+        if entry is not None:
+            return entry
+
+        # single-flight: the first caller downloads, the others wait for it
+        with self._lock:
+            lock = self._inflight.setdefault((key, etag), threading.Lock())
+        with lock:
+            entry = self.lookup(key, etag)
+            if entry is not None:
+                return entry
+            with self._lock:
+                self.misses += 1
+            try:
+                entry = self._store(key, etag, download)
+            finally:
+                with self._lock:
+                    self._inflight.pop((key, etag), None)
+        self._evict(keep=entry)
+        return entry
+
+    def clear(self):
+        for entry in glob.glob(os.path.join(self.directory, "*.*")):
+            self._remove(entry)
+
+    def _store(self, key, etag, download) -> str:
+        entry = self._entry(key, etag)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as stream:
+                download(stream)
+            os.replace(tmp, entry)
+        except BaseException:
+            self._remove(tmp)
+            raise
+
+        # drop entries of older versions of the same file
+        for stale in glob.glob(os.path.join(self.directory, self._hash(key) + ".*")):
+            if stale != entry and not stale.endswith(".tmp"):
+                self._remove(stale)
+        return entry
+
+    def _evict(self, keep=None):
+        _evict(self.directory, self.max_bytes, keep)
+
+    def _entry(self, key, etag) -> str:
+        return os.path.join(self.directory, "{}.{}".format(self._hash(key), self._hash(etag)))
+
+    @staticmethod
+    def _hash(value: str) -> str:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def _remove(path):
+        # another process may be evicting (or reading, on Windows) the same file
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResultCache():
+    """クエリ結果のキャッシュ. (パス, ETag, 正規化したSQL)をキーとする
+
+    メモリ(LRU)とディスクの2段で保持し、どちらも合計サイズの上限を超えると古いものから削除する。
+    同じパスの新しいETagの結果を保存した時点で、古いETagの結果は両方の段から削除する。
+    メモリにはレコードのリストをそのまま保持し、ヒット時は同じリストを返す (キャッシュと共有する
+    ため、返したリストとdictは変更しないこと)。ディスクにはArrow IPC形式で列毎に保存するため、
+    共有ディレクトリのエントリを読んでもコードは実行されない。列の値の型が揃っていない結果は
+    メモリにのみ保持する。
+
+    Args:
+        directory (str, optional): ディスクの保存先. Noneの場合はメモリのみ. Defaults to None.
+        max_bytes (int, optional): ディスクの合計サイズの上限. Defaults to DEFAULT_RESULT_CACHE_MAX_BYTES.
+        memory_bytes (int, optional): メモリの合計サイズの上限. Defaults to DEFAULT_RESULT_CACHE_MEMORY_BYTES.
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = DEFAULT_RESULT_CACHE_MAX_BYTES,
+                 memory_bytes: int = DEFAULT_RESULT_CACHE_MEMORY_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._etags = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "memory_bytes": self._memory_size, "memory_entries": len(self._memory)}
+
+    def get(self, path: str, etag: str, sql: str):
+        """キャッシュした結果を返す. 無い場合はNone"""
+        key = (path, etag, normalize_sql(sql))
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                records = cached[0]
+        if cached is None and self.directory is not None:
+            records = self._read(key)
+            if records is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, records)
+        elif cached is None:
+            records = None
+        if records is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return records
+
+    def put(self, path: str, etag: str, sql: str, records: list):
+        """結果を保存する"""
+        key = (path, etag, normalize_sql(sql))
+        records = list(records)
+        self._remember(key, records)
+        if self.directory is None:
+            return
+        data = _dumps(records)
+        if data is None:
+            return
+
+        entry = self._entry(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, entry)
+        except BaseException:
+            ReadCache._remove(tmp)
+            raise
+
+        # results of older versions of the file are never read again
+        prefix = ReadCache._hash(path) + "."
+        current = prefix + ReadCache._hash(etag) + "."
+        for stale in glob.glob(os.path.join(self.directory, prefix + "*")):
+            name = os.path.basename(stale)
+            if not name.startswith(current) and not name.endswith(".tmp"):
+                ReadCache._remove(stale)
+        self._evict(keep=entry)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._etags.clear()
+        if self.directory is not None:
+            for entry in glob.glob(os.path.join(self.directory, "*.*")):
+                ReadCache._remove(entry)
+
+    def _remember(self, key, records: list):
+        path, etag, _ = key
+        size = _sizeof(records)
+        with self._lock:
+            if self._etags.get(path) != etag:
+                self._etags[path] = etag
+                for stale in [k for k in self._memory if k[0] == path and k[1] != etag]:
+                    self._memory_size -= self._memory.pop(stale)[1]
+            if size > self.memory_bytes:
+                return
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_size -= previous[1]
+            self._memory[key] = (records, size)
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= evicted[1]
+
+    def _read(self, key):
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                data = f.read()
+            # mtime doubles as the LRU access time
+            os.utime(entry)
+        except OSError:
+            return None
+        records = _loads(data)
+        if records is None:
+            ReadCache._remove(entry)
+        return records
+
+    def _evict(self, keep=None):
+        _evict(self.directory, self.max_bytes, keep)
+
+    def _entry(self, key) -> str:
+        path, etag, sql = key
+        return os.path.join(self.directory, "{}.{}.{}".format(
+            ReadCache._hash(path), ReadCache._hash(etag), ReadCache._hash(sql)))
+
+
+def normalize_sql(sql: str) -> str:
+    """空白の違いを除いたSQL. 引用符の中はそのまま残す"""
+    parts = []
+    for i, part in enumerate(_SQL_QUOTED.split(sql.strip().rstrip(";").strip())):
+        if i % 2:
+            parts.append(part)
+        else:
+            part = _SQL_SPACES.sub(" ", part)
+            parts.append(_SQL_OPERATOR_SPACES.sub(r"\1", part))
+    return "".join(parts)
+
+
+def _evict(directory: str, max_bytes: int, keep: str = None):
+    """合計サイズがmax_bytesを超えた分を最終アクセス(mtime)が古いエントリから削除する"""
+    entries = []
+    for entry in glob.glob(os.path.join(directory, "*.*")):
+        if entry.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry != keep:
+            ReadCache._remove(entry)
+            total -= size
+
+
+def _dumps(records: list) -> bytes:
+    """レコードをArrow IPC形式にする. 列のキーか値の型が揃っていない場合はNone"""
+    import pyarrow as pa
+
+    names = list(records[0]) if records else []
+    if any(len(record) != len(names) for record in records):
+        return None
+    try:
+        columns = {name: [record[name] for record in records] for name in names}
+    except KeyError:
+        return None
+    for values in columns.values():
+        # e.g. [1, 1.5] would come back as [1.0, 1.5]
+        types = set(map(type, values))
+        types.discard(type(None))
+        if len(types) > 1 or not types <= _ARROW_TYPES:
+            return None
+    try:
+        table = pa.table(columns)
+    except (pa.ArrowException, OverflowError):
+        # integers beyond int64
+        return None
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return _RESULT_MAGIC + sink.getvalue().to_pybytes()
+
+
+def _loads(data: bytes) -> list:
+    """_dumpsで保存したレコードを読む. 形式が違う場合はNone"""
+    import pyarrow as pa
+
+    if not data.startswith(_RESULT_MAGIC):
+        return None
+    try:
+        table = pa.ipc.open_file(pa.py_buffer(data).slice(len(_RESULT_MAGIC))).read_all()
+    except pa.ArrowException:
+        return None
+    return table.to_pylist()
+
+
+def _sizeof(records: list) -> int:
+    # estimated from evenly spaced records, measuring every one costs as much as decoding them
+    if not records:
+        return sys.getsizeof(records)
+    step = max(len(records) // _SIZE_SAMPLES, 1)
+    sample = records[::step]
+    sampled = sum(sys.getsizeof(record) + sum(map(sys.getsizeof, record.values())) for record in sample)
+    return sys.getsizeof(records) + sampled * len(records) // len(sample)
@@ -0,0 +1,438 @@
+import re
+import ast
+import functools
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+
+
+class Dialect():
+    """式をSQLへ変換する際の方言
+
+    Args:
+        name (str): 方言の名前
+        table (str): FROM句のテーブル名
+        timestamp_type (str): タイムスタンプへCASTする型名
+        timestamp_literal (str): タイムスタンプのリテラルの書式. {}にISO 8601の文字列が入る
+    """
+
+    def __init__(self, name: str, table: str, timestamp_type: str, timestamp_literal: str):
+        self.name = name
+        self.table = table
+        self.timestamp_type = timestamp_type
+        self.timestamp_literal = timestamp_literal
+
+    def __repr__(self):
+        return "Dialect({!r})".format(self.name)
+
+
+# SQL of the storage quick query (query_file)
+QUICK_QUERY = Dialect("quick_query", "BlobStorage", "TIMESTAMP", "TO_TIMESTAMP('{}')")
+
+_COMPARISONS = {"=", "!=", "<", "<=", ">", ">="}
+_TIMESTAMP_TYPES = (datetime, date, np.datetime64)
+_TIMESTAMP_STRING = re.compile(r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?")
+
+
+class Expr():
+    """クエリの条件式
+
+    col()で作った列と値を比較演算子・isin・between・likeなどで組み合わせ、
+    &(AND)、|(OR)、~(NOT)でつなぐ。Pythonの優先順位では&と|が比較より先に評価されるため、
+    比較は括弧で囲む。
+
+    (col("room_id") > 5) & col("create_time").between(start, end) | col("name").like("%bot%")
+
+    式は構造が同じであれば等しいハッシュを持ち、SQLへの変換結果はメモ化される。
+    """
+
+    __slots__ = ("key",)
+
+    def sql(self, dialect: Dialect = QUICK_QUERY) -> str:
+        """WHERE句の条件としてSQLへ変換する"""
+        return _compile(self, dialect)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __bool__(self):
+        raise TypeError("an expression has no truth value, combine conditions with &, | and ~")
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.sql())
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __rand__(self, other):
+        return And(other, self)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __ror__(self, other):
+        return Or(other, self)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        return _compare("=", self, other)
+
+    def __ne__(self, other):
+        return _compare("!=", self, other)
+
+    def __lt__(self, other):
+        return _compare("<", self, other)
+
+    def __le__(self, other):
+        return _compare("<=", self, other)
+
+    def __gt__(self, other):
+        return _compare(">", self, other)
+
+    def __ge__(self, other):
+        return _compare(">=", self, other)
+
+    def isin(self, values):
+        return In(self, values)
+
+    def notin(self, values):
+        return In(self, values, negate=True)
+
+    def like(self, pattern: str):
+        return Like(self, pattern)
+
+    def not_like(self, pattern: str):
+        return Like(self, pattern, negate=True)
+
+    def between(self, lower, upper):
+        return Between(self, lower, upper)
+
+    def isnull(self):
+        return IsNull(self)
+
+    def notnull(self):
+        return IsNull(self, negate=True)
+
+    def cast(self, type_name: str):
+        return Cast(self, type_name)
+
+    def _sql(self, dialect: Dialect) -> str:
+        raise NotImplementedError
+
+
+class Column(Expr):
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.key = ("col", name)
+
+    def _sql(self, dialect):
+        return '"{}"'.format(self.name.replace('"', '""'))
+
+
+class Literal(Expr):
+    __slots__ = ("value", "timestamp")
+
+    def __init__(self, value):
+        self.timestamp = isinstance(value, _TIMESTAMP_TYPES)
+        if self.timestamp:
+            value = pd.Timestamp(value)
+        elif isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, (list, tuple, set, dict)):
+            raise TypeError("a literal must be a scalar, got {}".format(type(value).__name__))
+        self.value = value
+        # the type keeps 1, 1.0 and True apart
+        self.key = ("lit", type(value).__name__, value)
+
+    def _sql(self, dialect):
+        value = self.value
+        if self.timestamp:
+            # timestamps without a timezone are assumed to be UTC
+            text = value.isoformat() + ("+00:00" if value.tzinfo is None else "")
+            return dialect.timestamp_literal.format(text)
+        if value is None:
+            return "NULL"
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            if value != value or value in (float("inf"), float("-inf")):
+                raise ValueError("{} has no SQL literal".format(value))
+            return repr(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+
+class Cast(Expr):
+    __slots__ = ("expr", "type_name")
+
+    def __init__(self, expr, type_name: str):
+        self.expr = _wrap(expr)
+        self.type_name = type_name
+        self.key = ("cast", self.expr.key, type_name)
+
+    def _sql(self, dialect):
+        type_name = dialect.timestamp_type if self.type_name.upper() == "TIMESTAMP" else self.type_name
+        return "CAST({} AS {})".format(self.expr._sql(dialect), type_name)
+
+
+class Condition(Expr):
+    """真偽値になる式. &, |, ~でつなげるのはこの式のみ"""
+
+    __slots__ = ()
+
+
+class Comparison(Condition):
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op: str, left, right):
+        if op not in _COMPARISONS:
+            raise ValueError("unsupported comparison: {}".format(op))
+        self.op = op
+        self.left, self.right = _cast_for_timestamp(_wrap(left), _wrap(right))
+        self.key = ("cmp", op, self.left.key, self.right.key)
+
+    def __bool__(self):
+        # makes == usable for hashing: expressions are equal when their structure is
+        if self.op == "=":
+            return self.left.key == self.right.key
+        if self.op == "!=":
+            return self.left.key != self.right.key
+        return super().__bool__()
+
+    def _sql(self, dialect):
+        return "{}{}{}".format(self.left._sql(dialect), self.op, self.right._sql(dialect))
+
+
+class Between(Condition):
+    __slots__ = ("expr", "lower", "upper")
+
+    def __init__(self, expr, lower, upper):
+        expr = _wrap(expr)
+        lower, upper = _wrap(lower), _wrap(upper)
+        self.expr, self.lower = _cast_for_timestamp(expr, lower)
+        self.expr, self.upper = _cast_for_timestamp(self.expr, upper)
+        self.key = ("between", self.expr.key, self.lower.key, self.upper.key)
+
+    def _sql(self, dialect):
+        return "{} BETWEEN {} AND {}".format(
+            self.expr._sql(dialect), self.lower._sql(dialect), self.upper._sql(dialect))
+
+
+class In(Condition):
+    __slots__ = ("expr", "values", "negate")
+
+    def __init__(self, expr, values, negate: bool = False):
+        if isinstance(values, (str, bytes)) or not hasattr(values, "__iter__"):
+            raise TypeError("isin expects a list of values, got {}".format(type(values).__name__))
+        values = tuple(_wrap(value) for value in values)
+        expr = _wrap(expr)
+        for value in values:
+            expr, _ = _cast_for_timestamp(expr, value)
+        self.expr = expr
+        self.values = values
+        self.negate = negate
+        self.key = ("in", self.expr.key, tuple(value.key for value in values), negate)
+
+    def _sql(self, dialect):
+        return "{} {}IN ({})".format(self.expr._sql(dialect), "NOT " if self.negate else "",
+                                     ",".join(value._sql(dialect) for value in self.values))
+
+
+class Like(Condition):
+    __slots__ = ("expr", "pattern", "negate")
+
+    def __init__(self, expr, pattern: str, negate: bool = False):
+        self.expr = _wrap(expr)
+        self.pattern = _wrap(pattern)
+        self.negate = negate
+        self.key = ("like", self.expr.key, self.pattern.key, negate)
+
+    def _sql(self, dialect):
+        return "{} {}LIKE {}".format(self.expr._sql(dialect), "NOT " if self.negate else "", self.pattern._sql(dialect))
+
+
+class IsNull(Condition):
+    __slots__ = ("expr", "negate")
+
+    def __init__(self, expr, negate: bool = False):
+        self.expr = _wrap(expr)
+        self.negate = negate
+        self.key = ("isnull", self.expr.key, negate)
+
+    def _sql(self, dialect):
+        return "{} IS {}NULL".format(self.expr._sql(dialect), "NOT " if self.negate else "")
+
+
+class _Junction(Condition):
+    __slots__ = ("items",)
+    operator = None
+
+    def __init__(self, *items):
+        flattened = []
+        for item in items:
+            if not isinstance(item, Condition):
+                raise TypeError("{!r} is not a condition; put comparisons in parentheses, "
+                                "e.g. (col('x') > 5) & (col('y') < 3)".format(item))
+            flattened.extend(item.items if type(item) is type(self) else [item])
+        if not flattened:
+            raise ValueError("{} needs at least one condition".format(type(self).__name__))
+        self.items = tuple(flattened)
+        self.key = (self.operator, tuple(item.key for item in self.items))
+
+    def _sql(self, dialect):
+        if len(self.items) == 1:
+            return self.items[0]._sql(dialect)
+        return " {} ".format(self.operator).join(
+            "({})".format(item._sql(dialect)) if isinstance(item, _Junction) else item._sql(dialect)
+            for item in self.items)
+
+
+class And(_Junction):
+    __slots__ = ()
+    operator = "AND"
+
+
+class Or(_Junction):
+    __slots__ = ()
+    operator = "OR"
+
+
+class Not(Condition):
+    __slots__ = ("expr",)
+
+    def __init__(self, expr):
+        if not isinstance(expr, Condition):
+            raise TypeError("{!r} is not a condition".format(expr))
+        self.expr = expr
+        self.key = ("not", expr.key)
+
+    def _sql(self, dialect):
+        return "NOT ({})".format(self.expr._sql(dialect))
+
+
+def col(name: str) -> Column:
+    """列を参照する式を作成する
+
+    Args:
+        name (str): 列名
+
+    Returns:
+        Column: 列の式
+    """
+    return Column(name)
+
+
+def _wrap(value) -> Expr:
+    return value if isinstance(value, Expr) else Literal(value)
+
+
+def _compare(op: str, left, right) -> Condition:
+    if isinstance(right, Literal) and right.value is None or right is None:
+        if op in ("=", "!="):
+            return IsNull(left, negate=op == "!=")
+    return Comparison(op, left, right)
+
+
+def _cast_for_timestamp(expr: Expr, value: Expr):
+    # columns are read as text, so comparing one with a timestamp casts it first
+    if isinstance(expr, Column) and isinstance(value, Literal) and value.timestamp:
+        expr = Cast(expr, "TIMESTAMP")
+    return expr, value
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(expr: Expr, dialect: Dialect) -> str:
+    return expr._sql(dialect)
+
+
+def select(where: Expr = None, selected_vars="*", dialect: Dialect = QUICK_QUERY) -> str:
+    """条件式からクエリ全体を作成する
+
+    Args:
+        where (Expr, optional): WHERE句の条件. Defaults to None.
+        selected_vars (optional): 選択する列のリスト. 文字列の場合は全列. Defaults to "*".
+        dialect (Dialect, optional): SQLの方言. Defaults to QUICK_QUERY.
+
+    Returns:
+        str: クエリ文字列
+    """
+    selected_vars = "*" if isinstance(selected_vars, str) else tuple(selected_vars)
+    return _select(where, selected_vars, dialect)
+
+
+@functools.lru_cache(maxsize=4096)
+def _select(where, selected_vars, dialect) -> str:
+    columns = "*" if selected_vars == "*" else ",".join(Column(name)._sql(dialect) for name in selected_vars)
+    sql = "SELECT {} FROM {}".format(columns, dialect.table)
+    if where is not None:
+        sql += " WHERE " + _compile(where, dialect)
+    return sql
+
+
+def as_condition(condition) -> Condition:
+    """Exprまたは従来の"table['x'] > 5"形式の文字列を条件式へ変換する
+
+    文字列はevalせずに構文木から変換する. 使えるのはtable['列名']またはtable.列名と定数の比較、
+    isin, notin, like, not_like, between, isnull, notnull, &, |, ~のみ.
+    日付形式の文字列はタイムスタンプとして扱う.
+    """
+    if isinstance(condition, Condition):
+        return condition
+    if not isinstance(condition, str):
+        raise TypeError("expected an expression or a condition string, got {}".format(type(condition).__name__))
+    try:
+        tree = ast.parse(condition.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError("invalid condition {!r}: {}".format(condition, e.msg))
+    result = _from_ast(tree.body, condition)
+    if not isinstance(result, Condition):
+        raise ValueError("{!r} is not a condition".format(condition))
+    return result
+
+
+_AST_COMPARISONS = {ast.Eq: "=", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+_AST_METHODS = {"isin", "notin", "like", "not_like", "between", "isnull", "notnull"}
+
+
+def _from_ast(node, text: str):
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _AST_COMPARISONS:
+        return _compare(_AST_COMPARISONS[type(node.ops[0])],
+                        _from_ast(node.left, text), _from_ast(node.comparators[0], text))
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        left, right = _from_ast(node.left, text), _from_ast(node.right, text)
+        return And(left, right) if isinstance(node.op, ast.BitAnd) else Or(left, right)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        return Not(_from_ast(node.operand, text))
+    if isinstance(node, ast.Subscript) and _is_table(node.value):
+        key = node.slice
+        if isinstance(key, ast.Constant) and isinstance(key.value, str):
+            return Column(key.value)
+    if isinstance(node, ast.Attribute) and _is_table(node.value):
+        return Column(node.attr)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in _AST_METHODS \
+            and not node.keywords:
+        target = _from_ast(node.func.value, text)
+        args = [_literal(arg, text) for arg in node.args]
+        return getattr(target, node.func.attr)(*args)
+    if isinstance(node, (ast.Constant, ast.UnaryOp, ast.List, ast.Tuple)):
+        return _wrap(_literal(node, text))
+    raise ValueError("unsupported syntax in condition {!r}: {}".format(text, ast.dump(node)))
+
+
+def _is_table(node) -> bool:
+    return isinstance(node, ast.Name) and node.id == "table"
+
+
+def _literal(node, text: str):
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_literal(item, text) for item in node.elts]
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        raise ValueError("unsupported value in condition {!r}: {}".format(text, ast.dump(node)))
+    if isinstance(value, str) and _TIMESTAMP_STRING.fullmatch(value):
+        return pd.Timestamp(value)
+    return value
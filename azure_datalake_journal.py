@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# uploads running at once and bytes of one path uploaded with a single flush
+DEFAULT_JOURNAL_CONCURRENCY = 4
+DEFAULT_JOURNAL_BATCH_BYTES = 64 * 1024 * 1024
+# delay before retrying a path whose upload failed, doubled up to the maximum
+DEFAULT_RETRY_BACKOFF = 1.0
+DEFAULT_MAX_RETRY_BACKOFF = 60.0
+
+
+class JournalPending(TimeoutError):
+    """ジャーナルのパスのアップロードが期限までに終わらなかった"""
+
+
+class _Entry():
+    __slots__ = ("seq", "path", "append", "size")
+
+    def __init__(self, seq: int, path: str, append: bool, size: int):
+        self.seq = seq
+        self.path = path
+        self.append = append
+        self.size = size
+
+
+class JournalBatch():
+    """1回のアップロードでまとめて送るジャーナルのエントリ
+
+    appendがFALSEの場合はファイルを作り直してfilesの内容を書き込み、TRUEの場合は末尾に追記する。
+    追記する前にcheckpoint(offset)で追記開始位置を記録しておくと、アップロード後に
+    ジャーナルを消す前に停止しても、再起動後にoffset(記録した開始位置)から二重に追記したか判断できる。
+    """
+
+    def __init__(self, journal, path: str, entries: list, superseded: list, offset: int = None):
+        self.journal = journal
+        self.path = path
+        self.entries = entries
+        self.superseded = superseded
+        self.append = entries[0].append
+        self.files = [journal._data_path(entry.seq) for entry in entries]
+        self.length = sum(entry.size for entry in entries)
+        self.offset = offset
+
+    def checkpoint(self, offset: int):
+        self.offset = offset
+        _write_json(self.journal._marker_path(self.entries[0].seq), {
+            "path": self.path, "seqs": [entry.seq for entry in self.entries],
+            "offset": offset, "length": self.length}, self.journal.fsync)
+
+
+class WriteJournal():
+    """ローカルディスクの書き込みジャーナルと、ストレージへ書き出すバックグラウンドのアップローダー
+
+    add()はデータをdirectoryへ書き込んでfsyncした時点で返り、アップローダーが同じパスの
+    エントリをbatch_bytesまでまとめてupload(batch)で送る。後から上書きされたエントリは送らない。
+    パス毎の順序は保ち、異なるパスは最大max_concurrency本を同時に送る。失敗したパスは
+    指数バックオフの後に再試行する。アップロード済みのエントリは削除し、起動時には
+    directoryに残っているエントリを読み込んで送り直す。1つのdirectoryを複数のWriteJournalで共有しないこと。
+
+    Args:
+        directory (str): ジャーナルのディレクトリ
+        upload (callable): JournalBatchを受け取り、ストレージへ書き込む関数
+        max_concurrency (int, optional): 同時にアップロードするパスの数. Defaults to DEFAULT_JOURNAL_CONCURRENCY.
+        batch_bytes (int, optional): 1回のアップロードにまとめる最大サイズ(byte).
+            Defaults to DEFAULT_JOURNAL_BATCH_BYTES.
+        max_bytes (int, optional): 未アップロードのデータの上限(byte). 超えるとadd()は空くまで待つ.
+            Defaults to None (無制限).
+        fsync (bool, optional): 書き込み毎にfsyncする. Defaults to True.
+    """
+
+    def __init__(self, directory: str, upload, max_concurrency: int = DEFAULT_JOURNAL_CONCURRENCY,
+                 batch_bytes: int = DEFAULT_JOURNAL_BATCH_BYTES, max_bytes: int = None, fsync: bool = True):
+        self.directory = directory
+        self.upload = upload
+        self.max_concurrency = max_concurrency
+        self.batch_bytes = batch_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.pending_bytes = 0
+        self.uploaded = 0
+        self.failures = 0
+        self.last_error = None
+        self._entries = {}
+        self._inflight = set()
+        self._resume = {}
+        self._retry_at = {}
+        self._backoff = {}
+        self._seq = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="azure-datalake-journal")
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def add(self, path: str, blocks, append: bool = False) -> int:
+        """データをジャーナルに書き込む
+
+        Args:
+            path (str): ストレージのパス
+            blocks (iterable): 書き込むbytesのイテレーター
+            append (bool, optional): TRUEは追記、FALSEは上書き. Defaults to False.
+
+        Returns:
+            int: エントリの通し番号
+        """
+        with self._cond:
+            if self._closed:
+                raise ValueError("write to a closed journal")
+            while self.max_bytes is not None and self.pending_bytes >= self.max_bytes:
+                self._cond.wait()
+            seq = self._seq
+            self._seq += 1
+
+        data_path = self._data_path(seq)
+        size = 0
+        with open(data_path + ".tmp", "wb") as f:
+            for block in blocks:
+                f.write(block)
+                size += len(block)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(data_path + ".tmp", data_path)
+        # the manifest is written last, so a crash before it leaves only an orphan data file
+        _write_json(self._manifest_path(seq), {"path": path, "append": append, "size": size}, self.fsync)
+        if self.fsync:
+            _sync_directory(self.directory)
+
+        entry = _Entry(seq, path, append, size)
+        with self._cond:
+            entries = self._entries.setdefault(path, [])
+            entries.append(entry)
+            if len(entries) > 1 and entries[-2].seq > seq:
+                entries.sort(key=lambda e: e.seq)
+            self.pending_bytes += size
+            self._cond.notify_all()
+        return seq
+
+    def read(self, path: str):
+        """まだアップロードしていないパスの内容をジャーナルから読み込む
+
+        Returns:
+            bytes: 上書きを含むエントリがあればファイル全体の内容. 追記のみの場合はFALSE、
+                エントリが無い場合はNone
+        """
+        with self._cond:
+            entries = self._entries.get(path)
+            if not entries:
+                return None
+            start = _last_write(entries)
+            if start is None:
+                return False
+            # read under the lock so that the uploader cannot delete the files meanwhile
+            data = bytearray()
+            for entry in entries[start:]:
+                with open(self._data_path(entry.seq), "rb") as f:
+                    data += f.read()
+            return bytes(data)
+
+    def pending(self, path: str) -> bool:
+        with self._cond:
+            return bool(self._entries.get(path))
+
+    def wait_for_path(self, path: str, timeout: float = None) -> bool:
+        """指定したパスのエントリが全てアップロードされるまで待つ"""
+        with self._cond:
+            self._retry_now()
+            return self._cond.wait_for(lambda: not self._entries.get(path), timeout)
+
+    def flush(self, timeout: float = None) -> bool:
+        """呼び出し時点までに書き込んだエントリが全てアップロードされるまで待つ
+
+        バックオフ中のパスはすぐに再試行する.
+
+        Args:
+            timeout (float, optional): 最大の待ち時間(秒). Defaults to None.
+
+        Returns:
+            bool: 期限内に完了した場合はTRUE
+        """
+        with self._cond:
+            barrier = self._seq
+            self._retry_now()
+            return self._cond.wait_for(lambda: all(
+                entries[0].seq >= barrier for entries in self._entries.values() if entries), timeout)
+
+    def wait_for_drain(self, timeout: float = None) -> bool:
+        """ジャーナルが空になるまで待つ
+
+        Args:
+            timeout (float, optional): 最大の待ち時間(秒). Defaults to None.
+
+        Returns:
+            bool: 期限内に空になった場合はTRUE
+        """
+        with self._cond:
+            self._retry_now()
+            return self._cond.wait_for(lambda: not any(self._entries.values()), timeout)
+
+    def close(self, timeout: float = None) -> bool:
+        """アップロードを待ってからアップローダーを止める. 残ったエントリは次回起動時に送る"""
+        drained = self.wait_for_drain(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+        return drained
+
+    @property
+    def stats(self) -> dict:
+        with self._cond:
+            return {"pending_entries": sum(len(entries) for entries in self._entries.values()),
+                    "pending_bytes": self.pending_bytes, "uploaded": self.uploaded,
+                    "failures": self.failures, "last_error": repr(self.last_error) if self.last_error else None}
+
+    def _retry_now(self):
+        self._retry_at.clear()
+        self._cond.notify_all()
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._closed:
+                batch = self._next_batch() if len(self._inflight) < self.max_concurrency else None
+                if batch is None:
+                    now = time.monotonic()
+                    retry_at = [t for path, t in self._retry_at.items() if path not in self._inflight]
+                    self._cond.wait(timeout=max(min(retry_at) - now, 0.0) if retry_at else None)
+                    continue
+                self._inflight.add(batch.path)
+                self._executor.submit(self._upload, batch)
+
+    def _next_batch(self):
+        now = time.monotonic()
+        for path, entries in self._entries.items():
+            if not entries or path in self._inflight or self._retry_at.get(path, 0) > now:
+                continue
+
+            # an interrupted append is resumed with exactly the same entries
+            marker = self._resume.get(path)
+            if marker is not None:
+                seqs = set(marker["seqs"])
+                return JournalBatch(self, path, [entry for entry in entries if entry.seq in seqs], [],
+                                    marker["offset"])
+
+            # entries before the last overwrite never need to be uploaded
+            start = _last_write(entries) or 0
+            batch, size = [], 0
+            for entry in entries[start:]:
+                if batch and size + entry.size > self.batch_bytes:
+                    break
+                batch.append(entry)
+                size += entry.size
+            return JournalBatch(self, path, batch, entries[:start])
+        return None
+
+    def _upload(self, batch: JournalBatch):
+        try:
+            self.upload(batch)
+        except Exception as e:
+            with self._cond:
+                self.failures += 1
+                self.last_error = e
+                if batch.append and batch.offset is not None:
+                    # the flush may have been committed before the error, so the retry
+                    # checks the same entries against the same offset
+                    self._resume[batch.path] = {"path": batch.path, "seqs": [entry.seq for entry in batch.entries],
+                                                "offset": batch.offset, "length": batch.length}
+                backoff = self._backoff.get(batch.path, DEFAULT_RETRY_BACKOFF / 2) * 2
+                self._backoff[batch.path] = min(backoff, DEFAULT_MAX_RETRY_BACKOFF)
+                self._retry_at[batch.path] = time.monotonic() + self._backoff[batch.path]
+                self._inflight.discard(batch.path)
+                self._cond.notify_all()
+            return
+
+        done = batch.superseded + batch.entries
+        with self._cond:
+            entries = self._entries[batch.path]
+            self._entries[batch.path] = [entry for entry in entries if entry not in done]
+            if not self._entries[batch.path]:
+                del self._entries[batch.path]
+            self.pending_bytes -= sum(entry.size for entry in done)
+            self.uploaded += len(batch.entries)
+            self._resume.pop(batch.path, None)
+            self._backoff.pop(batch.path, None)
+            self._retry_at.pop(batch.path, None)
+            self._inflight.discard(batch.path)
+            # manifests go first and the append marker last, see _recover
+            for entry in done:
+                _remove(self._manifest_path(entry.seq))
+                _remove(self._data_path(entry.seq))
+            _remove(self._marker_path(batch.entries[0].seq))
+            self._cond.notify_all()
+
+    def _recover(self):
+        manifests, markers = {}, []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == ".tmp":
+                _remove(os.path.join(self.directory, name))
+            elif ext == ".json":
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        manifests[int(stem)] = json.load(f)
+                except (ValueError, OSError):
+                    # a torn manifest means add() never returned
+                    _remove(os.path.join(self.directory, name))
+            elif ext == ".inflight":
+                markers.append(name)
+
+        for seq, manifest in sorted(manifests.items()):
+            self._entries.setdefault(manifest["path"], []).append(
+                _Entry(seq, manifest["path"], manifest["append"], manifest["size"]))
+            self.pending_bytes += manifest["size"]
+        self._seq = max(manifests, default=-1) + 1
+
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == ".data" and int(stem) not in manifests:
+                _remove(os.path.join(self.directory, name))
+
+        for name in markers:
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    marker = json.load(f)
+            except (ValueError, OSError):
+                _remove(path)
+                continue
+            # manifests are removed only after a successful upload, so a partly
+            # removed batch was committed and its leftovers can go
+            if not all(seq in manifests for seq in marker["seqs"]):
+                self._discard(marker["path"], set(marker["seqs"]))
+                _remove(path)
+            else:
+                self._resume[marker["path"]] = marker
+
+    def _discard(self, path: str, seqs: set):
+        entries = self._entries.get(path, [])
+        for entry in [entry for entry in entries if entry.seq in seqs]:
+            entries.remove(entry)
+            self.pending_bytes -= entry.size
+            _remove(self._manifest_path(entry.seq))
+            _remove(self._data_path(entry.seq))
+        if not entries:
+            self._entries.pop(path, None)
+
+    def _data_path(self, seq: int) -> str:
+        return os.path.join(self.directory, "{:020d}.data".format(seq))
+
+    def _manifest_path(self, seq: int) -> str:
+        return os.path.join(self.directory, "{:020d}.json".format(seq))
+
+    def _marker_path(self, seq: int) -> str:
+        return os.path.join(self.directory, "{:020d}.inflight".format(seq))
+
+
+def _last_write(entries: list):
+    for i in range(len(entries) - 1, -1, -1):
+        if not entries[i].append:
+            return i
+    return None
+
+
+def _write_json(path: str, value: dict, fsync: bool = True):
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _sync_directory(directory: str):
+    # make the renames durable, not supported on Windows
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
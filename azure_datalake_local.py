@@ -0,0 +1,138 @@
+import io
+import re
+import threading
+from collections import OrderedDict
+from azure_datalake_expr import Dialect, Expr, select
+
+# same expressions as QUICK_QUERY, with timestamps DuckDB understands
+DUCKDB = Dialect("duckdb", "BlobStorage", "TIMESTAMPTZ", "TIMESTAMPTZ '{}'")
+
+OUTPUTS = ("arrow", "numpy", "pandas")
+# number of local files whose detected column types are kept
+DEFAULT_MAX_SCHEMAS = 1024
+
+_TO_TIMESTAMP = re.compile(r"TO_TIMESTAMP\(('(?:[^']|'')*')\)")
+_CAST_TIMESTAMP = re.compile(r"\bAS TIMESTAMP\)")
+
+
+class LocalQueryEngine():
+    """クイッククエリのSQLをDuckDBでローカルファイルに実行する
+
+    QueryBuilderやselect()で作ったクエリのBlobStorageを、ローカルファイルを読むビューに
+    置き換えて実行する。TO_TIMESTAMPとCAST(... AS TIMESTAMP)はタイムゾーン付きの
+    タイムスタンプとして扱い、タイムゾーンの無い値はUTCとみなす。列の型はDuckDBが推定し、
+    ファイル毎に推定結果を保持して2回目以降の推定を省く (パスが同じなら内容も同じとみなす)。
+
+    Args:
+        threads (int, optional): DuckDBのスレッド数. Defaults to None (DuckDBの既定値).
+        max_schemas (int, optional): 列の型を保持するファイル数. Defaults to DEFAULT_MAX_SCHEMAS.
+    """
+
+    def __init__(self, threads: int = None, max_schemas: int = DEFAULT_MAX_SCHEMAS):
+        import duckdb
+
+        self.Error = duckdb.Error
+        self.max_schemas = max_schemas
+        self._connection = duckdb.connect(config={} if threads is None else {"threads": threads})
+        self._lock = threading.Lock()
+        self._sources = OrderedDict()
+
+    def execute(self, sql_query, path: str, file_format: str = "csv", compression: str = None,
+                output: str = "arrow"):
+        """ローカルファイルにクエリを実行する
+
+        Args:
+            sql_query (str or Expr): クイッククエリのSQL、またはWHERE句の条件式
+            path (str): ローカルファイルのパス
+            file_format (str, optional): ファイルの形式(csv, json, parquet). Defaults to "csv".
+            compression (str, optional): 圧縮形式(gzip, zstd). Defaults to None.
+            output (str, optional): 結果の形式(arrow, numpy, pandas). Defaults to "arrow".
+
+        Returns:
+            pyarrow.Table: クエリ結果 (numpyは列名をキーとするnp.ndarrayのdict、pandasはpd.DataFrame)
+        """
+        sql = select(sql_query, dialect=DUCKDB) if isinstance(sql_query, Expr) else to_duckdb(sql_query)
+        # a cursor is a separate connection to the same database, so the view is private to this call
+        with self._lock:
+            cursor = self._connection.cursor()
+        try:
+            cursor.execute("SET TimeZone='UTC'")
+            cursor.execute("CREATE TEMP VIEW BlobStorage AS SELECT * FROM {}".format(
+                self._source(cursor, path, file_format, compression)))
+            table = cursor.execute(sql).arrow()
+            if hasattr(table, "read_all"):
+                # newer DuckDB returns a RecordBatchReader
+                table = table.read_all()
+        finally:
+            cursor.close()
+        return to_output(table, output)
+
+    def _source(self, cursor, path, file_format, compression) -> str:
+        # detecting the column types costs more than querying a small file, so it runs once per file
+        key = (path, file_format, compression)
+        with self._lock:
+            source = self._sources.get(key)
+            if source is not None:
+                self._sources.move_to_end(key)
+                return source
+
+        source = _source(path, file_format, compression)
+        if file_format != "parquet":
+            columns = cursor.execute("DESCRIBE SELECT * FROM {}".format(source)).fetchall()
+            source = _source(path, file_format, compression, {name: type_name for name, type_name, *_ in columns})
+        with self._lock:
+            self._sources[key] = source
+            while len(self._sources) > self.max_schemas:
+                self._sources.popitem(last=False)
+        return source
+
+
+def to_duckdb(sql: str) -> str:
+    """クイッククエリのSQLをDuckDBのSQLへ書き換える"""
+    sql = _TO_TIMESTAMP.sub(r"CAST(\1 AS TIMESTAMPTZ)", sql)
+    return _CAST_TIMESTAMP.sub("AS TIMESTAMPTZ)", sql)
+
+
+def read_csv_result(data: bytes):
+    """クイッククエリが返したヘッダー付きCSVを型を推定してpyarrow.Tableにする"""
+    import pyarrow as pa
+    from pyarrow import csv
+
+    if not data.strip():
+        return pa.table({})
+    return csv.read_csv(io.BytesIO(data))
+
+
+def to_output(table, output: str):
+    if output == "arrow":
+        return table
+    if output == "numpy":
+        return {name: column.to_numpy() for name, column in zip(table.column_names, table.columns)}
+    if output == "pandas":
+        return table.to_pandas()
+    raise ValueError("unsupported output: {} (expected one of {})".format(output, ", ".join(OUTPUTS)))
+
+
+def _source(path: str, file_format: str, compression: str, columns: dict = None) -> str:
+    path = _string(path)
+    # the cache entries have no extension to infer the compression from
+    compression = _string(compression or ("none" if file_format == "csv" else "uncompressed"))
+    if columns is not None:
+        columns = ", columns={{{}}}".format(
+            ", ".join("{}: {}".format(_string(name), _string(type_name)) for name, type_name in columns.items()))
+    if file_format == "csv":
+        # same dialect as the quick query input (_input_dialect)
+        if columns is None:
+            return "read_csv({}, header=true, delim=',', quote='\"', escape='\"', compression={})".format(
+                path, compression)
+        return "read_csv({}, header=true, delim=',', quote='\"', escape='\"', compression={}, " \
+               "auto_detect=false{})".format(path, compression, columns)
+    if file_format == "json":
+        return "read_json({}, format='newline_delimited', compression={}{})".format(path, compression, columns or "")
+    if file_format == "parquet":
+        return "read_parquet({})".format(path)
+    raise ValueError("unsupported file_format: {}".format(file_format))
+
+
+def _string(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
@@ -0,0 +1,221 @@
+import math
+import time
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+
+# upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+# operation being measured in the current context, set by _instrumented
+_current_operation = contextvars.ContextVar("azure_datalake_operation", default=None)
+_NULL_PHASE = contextlib.nullcontext()
+
+
+class _Histogram():
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class _Operation():
+    """Counters of one call of a public method, filled in by the response hook and phases."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.phases = {}
+        self.error = False
+        self._lock = threading.Lock()
+
+    def add_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_response(self, sent: int, received: int, retry: bool):
+        with self._lock:
+            self.requests += 1
+            self.retries += retry
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+
+class _Phase():
+    __slots__ = ("operation", "name", "started")
+
+    def __init__(self, operation, name):
+        self.operation = operation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.operation.add_phase(self.name, time.perf_counter() - self.started)
+
+
+class Metrics():
+    """AzureDatalakeV2の操作毎のメトリクスを集計するシンク
+
+    公開メソッド毎の処理時間のヒストグラム、リクエスト数、リトライ数、送受信バイト数、
+    エラー数と、内部処理(normalize, serialize, compress, upload, flush, revalidate, download, local_query)毎の
+    処理時間のヒストグラムを保持する。appender()とopen()が返すストリームの操作は
+    appender.write, appender.flush, appender.close, file.readintoとして集計する。
+    リクエスト数と転送量は共有レジストリ(get_service_client)で作成したサービスクライアントの
+    レスポンスフックから集計するため、get_service_client以外で作成したクライアントを
+    service_clientに渡した場合、リクエスト数と転送量は0になる (処理時間とエラー数は集計する)。
+
+    Args:
+        callback (callable, optional): 操作が終わる度にdictで呼ばれる関数. Defaults to None.
+        buckets (tuple, optional): ヒストグラムの上限値(秒). Defaults to DEFAULT_BUCKETS.
+    """
+
+    def __init__(self, callback=None, buckets=DEFAULT_BUCKETS):
+        self.callback = callback
+        self.buckets = tuple(buckets)
+        self.operations = {}
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation: _Operation, seconds: float):
+        with self._lock:
+            self.operations.setdefault(operation.name, _Histogram(self.buckets)).observe(seconds)
+            for phase, phase_seconds in operation.phases.items():
+                self.phases.setdefault((operation.name, phase), _Histogram(self.buckets)).observe(phase_seconds)
+            counters = self.counters.setdefault(operation.name, dict.fromkeys(
+                ("requests", "retries", "bytes_sent", "bytes_received", "errors"), 0))
+            counters["requests"] += operation.requests
+            counters["retries"] += operation.retries
+            counters["bytes_sent"] += operation.bytes_sent
+            counters["bytes_received"] += operation.bytes_received
+            counters["errors"] += operation.error
+
+        if self.callback is not None:
+            self.callback({
+                "operation": operation.name, "seconds": seconds, "phases": dict(operation.phases),
+                "requests": operation.requests, "retries": operation.retries,
+                "bytes_sent": operation.bytes_sent, "bytes_received": operation.bytes_received,
+                "error": operation.error,
+            })
+
+    def to_prometheus(self, prefix: str = "azure_datalake") -> str:
+        """集計結果をPrometheusのテキスト形式で出力する"""
+        lines = []
+        with self._lock:
+            lines.append("# TYPE {}_operation_seconds histogram".format(prefix))
+            for name, histogram in sorted(self.operations.items()):
+                lines += _histogram_lines(prefix + "_operation_seconds", 'operation="{}"'.format(name), histogram)
+            lines.append("# TYPE {}_phase_seconds histogram".format(prefix))
+            for (name, phase), histogram in sorted(self.phases.items()):
+                lines += _histogram_lines(prefix + "_phase_seconds",
+                                          'operation="{}",phase="{}"'.format(name, phase), histogram)
+            for counter in ("requests", "retries", "bytes_sent", "bytes_received", "errors"):
+                lines.append("# TYPE {}_{}_total counter".format(prefix, counter))
+                for name, counters in sorted(self.counters.items()):
+                    lines.append('{}_{}_total{{operation="{}"}} {}'.format(prefix, counter, name, counters[counter]))
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(metric: str, labels: str, histogram: _Histogram) -> list:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        le = "+Inf" if bound == math.inf else repr(bound)
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, le, cumulative))
+    lines.append("{}_sum{{{}}} {}".format(metric, labels, histogram.sum))
+    lines.append("{}_count{{{}}} {}".format(metric, labels, histogram.count))
+    return lines
+
+
+def _instrumented(method=None, name: str = None):
+    """Record a public method of AzureDatalakeV2 (or of a stream it returns) into
+    self.metrics, as the operation `name` (the method name by default). Calls made
+    while another method is being measured are attributed to the outer one."""
+    if method is None:
+        return functools.partial(_instrumented, name=name)
+    name = name or method.__name__
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None or _current_operation.get() is not None:
+                yield from method(self, *args, **kwargs)
+                return
+            operation = _Operation(name)
+            started = time.perf_counter()
+            generator = method(self, *args, **kwargs)
+            try:
+                while True:
+                    # only the steps of the generator run inside the operation
+                    token = _current_operation.set(operation)
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        _current_operation.reset(token)
+                    yield item
+            except BaseException:
+                operation.error = True
+                raise
+            finally:
+                generator.close()
+                metrics.record(operation, time.perf_counter() - started)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is None or _current_operation.get() is not None:
+            return method(self, *args, **kwargs)
+        operation = _Operation(name)
+        token = _current_operation.set(operation)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except BaseException:
+            operation.error = True
+            raise
+        finally:
+            _current_operation.reset(token)
+            metrics.record(operation, time.perf_counter() - started)
+    return wrapper
+
+
+def _phase(name: str):
+    """Context manager timing an internal phase of the operation being measured."""
+    operation = _current_operation.get()
+    if operation is None:
+        return _NULL_PHASE
+    return _Phase(operation, name)
+
+
+def _record_response(response):
+    # raw_response_hook of the shared service clients, called once per attempt
+    operation = _current_operation.get()
+    if operation is None:
+        return
+    status = response.http_response.status_code
+    sent = int(response.http_request.headers.get("Content-Length", 0) or 0)
+    received = int(response.http_response.headers.get("Content-Length", 0) or 0)
+    operation.add_response(sent, received, status in (408, 429) or status >= 500)
@@ -0,0 +1,206 @@
+import time
+import random
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+# status codes of responses worth another attempt
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class DeadlineExceeded(TimeoutError):
+    """ReadPolicyの期限までに読み込みが完了しなかった"""
+
+
+class ReadPolicy():
+    """読み込みの期限・リトライ・ヘッジの設定
+
+    失敗した試行はfull jitter付きの指数バックオフ(0〜min(max_backoff, backoff × 2^n)秒)の後に
+    再試行する。ヘッジを有効にした場合、試行がhedge_delay秒、または直近のレイテンシの
+    hedge_quantile分位点を過ぎても終わらなければ同じリクエストをもう1本送り、先に返った
+    結果を使う。読み込みは冪等なので、残った試行の結果は捨てる。
+
+    Args:
+        deadline (float, optional): 1回の呼び出しの期限(秒). Noneは無期限. Defaults to None.
+        max_attempts (int, optional): 最大試行回数 (ヘッジを除く). Defaults to 4.
+        backoff (float, optional): バックオフの初期値(秒). Defaults to 0.05.
+        max_backoff (float, optional): バックオフの上限(秒). Defaults to 2.0.
+        hedge_quantile (float, optional): ヘッジするレイテンシの分位点. Noneはヘッジしない.
+            Defaults to 0.95.
+        hedge_delay (float, optional): ヘッジまでの固定の待ち時間(秒). 指定した場合は
+            hedge_quantileより優先する. Defaults to None.
+        max_hedges (int, optional): 1回の試行に追加するリクエストの最大数. Defaults to 1.
+        min_hedge_delay (float, optional): ヘッジまでの最短の待ち時間(秒). レイテンシが
+            20件溜まるまではこの値を使う. Defaults to 0.05.
+        window (int, optional): 分位点の計算に使う直近のレイテンシの数. Defaults to 1000.
+    """
+
+    def __init__(self, deadline: float = None, max_attempts: int = 4, backoff: float = 0.05,
+                 max_backoff: float = 2.0, hedge_quantile: float = 0.95, hedge_delay: float = None,
+                 max_hedges: int = 1, min_hedge_delay: float = 0.05, window: int = 1000):
+        if max_attempts <= 0:
+            raise ValueError("max_attempts must be positive")
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.max_hedges = max_hedges
+        self.min_hedge_delay = min_hedge_delay
+        self.attempts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self._latencies = deque(maxlen=window)
+        self._quantile = None
+        self._observed = 0
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def call(self, fn, deadline: float = None):
+        """fnをポリシーに従って実行し、最初に成功した結果を返す
+
+        Args:
+            fn (callable): 引数なしで呼ばれる冪等な読み込み処理
+            deadline (float, optional): この呼び出しの期限(秒). Defaults to None (ポリシーの期限).
+
+        Returns:
+            fnの戻り値
+        """
+        deadline = self.deadline if deadline is None else deadline
+        expires = None if deadline is None else time.monotonic() + deadline
+        hedging = self.max_hedges > 0 and (self.hedge_delay is not None or self.hedge_quantile is not None)
+        if not hedging and expires is None:
+            return self._call_inline(fn)
+
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self._sleep_backoff(attempt, expires)
+            try:
+                return self._attempt(fn, expires, hedging)
+            except DeadlineExceeded:
+                raise
+            except BaseException as e:
+                if not _retryable(e):
+                    raise
+                error = e
+        raise error
+
+    def _call_inline(self, fn):
+        # no hedging and no deadline: retry in the calling thread
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self._sleep_backoff(attempt, None)
+            started = time.perf_counter()
+            try:
+                result = fn()
+            except BaseException as e:
+                if not _retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                continue
+            finally:
+                with self._lock:
+                    self.attempts += 1
+            self._observe(time.perf_counter() - started)
+            return result
+
+    def _attempt(self, fn, expires, hedging):
+        started = {}
+
+        def submit():
+            # one thread per attempt: a pool would queue the hedge behind abandoned slow attempts
+            future = Future()
+            threading.Thread(target=_run, args=(future, contextvars.copy_context(), fn), daemon=True).start()
+            started[future] = time.perf_counter()
+            with self._lock:
+                self.attempts += 1
+            return future
+
+        first = submit()
+        pending = {first}
+        hedges = 0
+        error = None
+        while pending:
+            timeout = _remaining(expires)
+            if hedging and hedges < self.max_hedges:
+                delay = self._current_hedge_delay()
+                timeout = delay if timeout is None else min(timeout, delay)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    result = future.result()
+                except BaseException as e:
+                    error = e
+                    continue
+                self._observe(time.perf_counter() - started[future])
+                if future is not first:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return result
+
+            if expires is not None and time.monotonic() >= expires:
+                raise DeadlineExceeded("read did not complete within the deadline")
+            if not done and hedging and hedges < self.max_hedges:
+                hedges += 1
+                with self._lock:
+                    self.hedges += 1
+                pending.add(submit())
+        raise error
+
+    def _sleep_backoff(self, attempt: int, expires):
+        with self._lock:
+            self.retries += 1
+            delay = self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        remaining = _remaining(expires)
+        if remaining is not None and remaining <= delay:
+            raise DeadlineExceeded("read did not complete within the deadline")
+        time.sleep(delay)
+
+    def _current_hedge_delay(self) -> float:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._lock:
+            if self._quantile is None:
+                return self.min_hedge_delay
+            return max(self._quantile, self.min_hedge_delay)
+
+    def _observe(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._observed += 1
+            # the quantile is refreshed every 16 samples instead of sorting on every read
+            if self.hedge_quantile is not None and self._observed % 16 == 0 and len(self._latencies) >= 20:
+                latencies = sorted(self._latencies)
+                self._quantile = latencies[min(int(len(latencies) * self.hedge_quantile), len(latencies) - 1)]
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {"attempts": self.attempts, "retries": self.retries, "hedges": self.hedges,
+                    "hedge_wins": self.hedge_wins, "hedge_delay": self._quantile}
+
+
+def _run(future: Future, context: contextvars.Context, fn):
+    try:
+        future.set_result(context.run(fn))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+def _remaining(expires):
+    if expires is None:
+        return None
+    return max(expires - time.monotonic(), 0.0)
+
+
+def _retryable(error: BaseException) -> bool:
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    if isinstance(error, HttpResponseError):
+        return error.status_code in RETRY_STATUS
+    return False
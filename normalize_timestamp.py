@@ -1,9 +1,55 @@
+import numpy as np
 import pandas as pd
 
+
 def normalize_timestamp(df: pd.DataFrame) -> pd.DataFrame:
-    dt_columns = df.select_dtypes('datetimetz')
-    df[dt_columns.columns] = dt_columns.apply(lambda x: x.dt.tz_convert('utc'))
-    dt_columns = df.select_dtypes('datetime64')
-    df[dt_columns.columns] = dt_columns.apply(lambda x: pd.to_datetime(x, utc=True))
-    df[dt_columns.columns] = dt_columns.apply(lambda x: x.dt.strftime('%Y-%m-%dT%H:%M:%S+00:00'))
-    return df
\ No newline at end of file
+    """Convert every datetime column to ISO-8601 UTC strings ("%Y-%m-%dT%H:%M:%S+00:00").
+
+    Naive columns are assumed to be UTC and tz-aware columns already in UTC are
+    not converted. Formatting works on the datetime64 values with numpy instead
+    of Series.dt.strftime. The input frame is not modified.
+    """
+    dt_columns = df.select_dtypes(['datetime', 'datetimetz']).columns
+    if not len(dt_columns):
+        return df
+
+    df = df.copy(deep=False)
+    for column in dt_columns:
+        df[column] = _format_utc(df[column])
+    return df
+
+
+def _format_utc(series: pd.Series) -> pd.Series:
+    # tz-aware values are stored as UTC, so dropping the tz only changes metadata
+    if series.dt.tz is not None:
+        series = series.dt.tz_convert(None)
+    values = series.to_numpy().astype('datetime64[s]')
+    formatted = np.char.add(np.datetime_as_string(values, unit='s'), '+00:00').astype(object)
+    formatted[np.isnat(values)] = np.nan
+    return pd.Series(formatted, index=series.index, name=series.name)
+
+
+def _normalize_timestamp_strftime(df: pd.DataFrame) -> pd.DataFrame:
+    # previous per-column apply/tz_convert/strftime approach, kept for the benchmark
+    df = df.copy()
+    dt_columns = df.select_dtypes(['datetime', 'datetimetz'])
+    df[dt_columns.columns] = dt_columns.apply(
+        lambda x: pd.to_datetime(x, utc=True).dt.strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+    return df
+
+
+if __name__ == '__main__':
+    import timeit
+
+    rows = 1_000_000
+    df = pd.DataFrame({
+        'naive': pd.date_range('2024-01-01', periods=rows, freq='s'),
+        'utc': pd.date_range('2024-01-01', periods=rows, freq='s', tz='UTC'),
+        'tokyo': pd.date_range('2024-01-01', periods=rows, freq='s', tz='Asia/Tokyo'),
+        'value': np.arange(rows),
+    })
+    assert normalize_timestamp(df).astype(str).equals(_normalize_timestamp_strftime(df).astype(str))
+
+    for fn in (_normalize_timestamp_strftime, normalize_timestamp):
+        seconds = min(timeit.repeat(lambda: fn(df), number=1, repeat=3))
+        print(f'{fn.__name__}: {seconds:.3f} s for {rows:,} rows x 3 datetime columns')
@@ -1,9 +1,35 @@
 import io
 import zipfile
+import threading
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
-__all__ = ['RemoteIOError', 'RemoteZip']
+__all__ = ['RemoteIOError', 'RemoteZip', 'get_session']
+
+# connections kept alive per host by the shared sessions
+DEFAULT_POOL_SIZE = 16
+# a streamed response with at most this many unread bytes is drained on close,
+# so its connection goes back to the pool instead of being closed
+MAX_DRAIN_BYTES = 64 * 1024
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+
+
+def get_session(url, pool_size=DEFAULT_POOL_SIZE):
+    """Return the keep-alive session shared by every RemoteZip of the url's host."""
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("%s://%s" % key, adapter)
+            _sessions[key] = session
+        return session
 
 
 class RemoteZipError(Exception):
@@ -43,7 +69,11 @@ class PartialBuffer:
 
     def close(self):
         if not self.buffer.closed:
-            self.buffer.close()
+            unread = self.offset + self.size - self.position
+            if self.stream and hasattr(self.buffer, 'drain_conn') and unread <= MAX_DRAIN_BYTES:
+                self.buffer.drain_conn()
+            else:
+                self.buffer.close()
             if hasattr(self.buffer, 'release_conn'):
                 self.buffer.release_conn()
 
@@ -132,9 +162,11 @@ class RemoteIO(io.IOBase):
 
 
 class RemoteZip(zipfile.ZipFile):
-    def __init__(self, url, initial_buffer_size=64*1024, **kwargs):
+    # session: anything with requests' get(), defaults to the shared session of the host
+    def __init__(self, url, initial_buffer_size=64*1024, session=None, **kwargs):
         self.kwargs = kwargs
         self.url = url
+        self.session = session if session is not None else get_session(url)
 
         rio = RemoteIO(self.fetch_fun, initial_buffer_size)
         super(RemoteZip, self).__init__(rio)
@@ -168,10 +200,10 @@ class RemoteZip(zipfile.ZipFile):
         return "bytes=%s-%s" % (range_min, range_max)
 
     @staticmethod
-    def request(url, range_header, kwargs):
+    def request(url, range_header, kwargs, session=requests):
         kwargs['headers'] = headers = dict(kwargs.get('headers', {}))
         headers['Range'] = range_header
-        res = requests.get(url, stream=True, **kwargs)
+        res = session.get(url, stream=True, **kwargs)
         res.raise_for_status()
         if 'Content-Range' not in res.headers:
             raise RangeNotSupported(
@@ -182,7 +214,7 @@ class RemoteZip(zipfile.ZipFile):
         range_header = self.make_header(*data_range)
         kwargs = dict(self.kwargs)
         try:
-            res, headers = self.request(self.url, range_header, kwargs)
+            res, headers = self.request(self.url, range_header, kwargs, self.session)
             return self.make_buffer(res, headers['Content-Range'], stream=stream)
         except IOError as e:
             raise RemoteIOError(str(e))
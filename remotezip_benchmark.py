@@ -0,0 +1,156 @@
+"""Benchmark RemoteZip range requests against a local range-capable HTTP server.
+
+The server speaks HTTP/1.1 with keep-alive and can delay every new connection to
+stand in for the TCP+TLS handshake of a remote host. Each run opens the archive
+and reads every member, once with a new connection per request (session=requests,
+the old behaviour) and once with the shared keep-alive session.
+
+    python remotezip_benchmark.py
+    python remotezip_benchmark.py --members 200 --member-size 4096 --handshake 0.03
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# zipfile.py next to this script is a different reader over sliceable objects; load the
+# standard library module first so that remotezip, imported below, subclasses that one
+_here = os.path.dirname(os.path.abspath(__file__))
+_path = sys.path[:]
+sys.path[:] = [entry for entry in sys.path if os.path.abspath(entry or ".") != _here]
+import zipfile  # noqa: E402
+sys.path[:] = _path
+
+import requests  # noqa: E402
+
+from remotezip import RemoteZip, get_session  # noqa: E402
+
+_RANGE = re.compile(r"bytes=(-?\d*)-?(\d*)")
+
+
+class RangeServer(ThreadingHTTPServer):
+    """Serve one in-memory file at every path, honouring Range headers."""
+
+    daemon_threads = True
+
+    def __init__(self, data, handshake=0.0):
+        super().__init__(("127.0.0.1", 0), _RangeHandler)
+        self.data = data
+        self.handshake = handshake
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%s/archive.zip" % self.server_address
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body are separate writes; like most servers, do not let Nagle hold the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server._lock:
+            self.server.connections += 1
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+
+    def do_GET(self):
+        with self.server._lock:
+            self.server.requests += 1
+        data = self.server.data
+        match = _RANGE.fullmatch(self.headers.get("Range", ""))
+        if match is None:
+            self._send(200, data, {})
+            return
+        first, last = match.groups()
+        if first.startswith("-"):
+            start, end = max(len(data) + int(first), 0), len(data) - 1
+        else:
+            start = int(first)
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+        self._send(206, data[start:end + 1],
+                   {"Content-Range": "bytes %d-%d/%d" % (start, end, len(data))})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_archive(members, member_size, seed=0):
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for i in range(members):
+            archive.writestr("member_%05d.bin" % i, rng.randbytes(member_size))
+    return buffer.getvalue()
+
+
+def read_members(url, session):
+    with RemoteZip(url, session=session) as archive:
+        for info in archive.infolist():
+            archive.read(info)
+
+
+def run(members=100, member_size=16 * 1024, repeat=3, handshake=0.0):
+    """Return requests/sec and connections per run with and without the shared session."""
+    data = make_archive(members, member_size)
+    server = RangeServer(data, handshake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    try:
+        for name, session in (("new_connection", requests), ("shared_session", get_session(server.url))):
+            read_members(server.url, session)
+            requests_before, connections_before = server.requests, server.connections
+            started = time.perf_counter()
+            for _ in range(repeat):
+                read_members(server.url, session)
+            seconds = time.perf_counter() - started
+            count = server.requests - requests_before
+            results.append({
+                "op": name, "members": members, "member_size": member_size, "handshake": handshake,
+                "requests": count, "connections": server.connections - connections_before,
+                "seconds": round(seconds, 4), "requests_per_sec": round(count / seconds, 1),
+            })
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--member-size", type=int, default=16 * 1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--handshake", type=float, default=0.0, help="seconds added to every new connection")
+    args = parser.parse_args()
+
+    results = run(args.members, args.member_size, args.repeat, args.handshake)
+    print(json.dumps(results, indent=2))
+    before, after = results
+    print("requests/sec: {} -> {} (x{:.1f}), connections: {} -> {}".format(
+        before["requests_per_sec"], after["requests_per_sec"],
+        after["requests_per_sec"] / before["requests_per_sec"], before["connections"], after["connections"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import json
+import threading
+import pytest
+import pandas as pd
+from azure.core.exceptions import ServiceResponseError
+from azure_datalake import AzureDatalakeV2, JournalPending
+from azure_datalake_benchmark import FakeDataLakeServiceClient, FakeFileClient
+from azure_datalake_journal import WriteJournal
+
+
+class Storage():
+    """upload callback keeping files in memory, like _upload_batch does on the service"""
+
+    def __init__(self, fail=False):
+        self.files = {}
+        self.batches = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def upload(self, batch):
+        if self.fail:
+            raise ConnectionError("uplink down")
+        data = b"".join(open(path, "rb").read() for path in batch.files)
+        with self.lock:
+            self.batches.append((batch.path, [entry.seq for entry in batch.entries], batch.append, batch.offset))
+            if batch.append:
+                current = self.files.get(batch.path, b"")
+                if batch.offset is not None and len(current) == batch.offset + batch.length:
+                    return
+                batch.checkpoint(len(current))
+                self.files[batch.path] = current + data
+            else:
+                self.files[batch.path] = data
+
+
+def _journal(directory, storage):
+    return WriteJournal(str(directory), storage.upload, fsync=False)
+
+
+def test_recovers_pending_entries_in_order(tmp_path):
+    journal = _journal(tmp_path, Storage(fail=True))
+    journal.add("a.csv", [b"head\n"])
+    journal.add("a.csv", [b"1\n"], append=True)
+    journal.add("a.csv", [b"2\n"], append=True)
+    assert not journal.close(timeout=0.1)
+
+    storage = Storage()
+    journal = _journal(tmp_path, storage)
+    assert journal.wait_for_drain(timeout=5)
+    journal.close()
+    assert storage.files == {"a.csv": b"head\n1\n2\n"}
+    assert os.listdir(tmp_path) == []
+
+
+def test_superseded_entries_are_not_uploaded(tmp_path):
+    journal = _journal(tmp_path, Storage(fail=True))
+    journal.add("a.csv", [b"old\n"])
+    journal.add("a.csv", [b"more\n"], append=True)
+    journal.add("a.csv", [b"new\n"])
+    journal.close(timeout=0.1)
+
+    storage = Storage()
+    journal = _journal(tmp_path, storage)
+    assert journal.wait_for_drain(timeout=5)
+    journal.close()
+    assert storage.files == {"a.csv": b"new\n"}
+    assert [seqs for _, seqs, _, _ in storage.batches] == [[2]]
+
+
+def test_recovery_removes_torn_and_orphan_files(tmp_path):
+    journal = _journal(tmp_path, Storage(fail=True))
+    journal.add("a.csv", [b"data\n"])
+    journal.close(timeout=0.1)
+    # add() stopped before its manifest, and a torn manifest of another entry
+    (tmp_path / "00000000000000000007.data").write_bytes(b"orphan")
+    (tmp_path / "00000000000000000008.json").write_text("{")
+    (tmp_path / "00000000000000000009.data.tmp").write_bytes(b"partial")
+
+    storage = Storage()
+    journal = _journal(tmp_path, storage)
+    assert journal.wait_for_drain(timeout=5)
+    journal.close()
+    assert storage.files == {"a.csv": b"data\n"}
+    assert os.listdir(tmp_path) == []
+
+
+def test_marker_resumes_append_without_duplicating(tmp_path):
+    journal = _journal(tmp_path, Storage(fail=True))
+    journal.add("a.csv", [b"1\n"], append=True)
+    journal.close(timeout=0.1)
+    # the append was flushed at offset 5, then the process stopped before removing the entry
+    (tmp_path / "00000000000000000000.inflight").write_text(json.dumps(
+        {"path": "a.csv", "seqs": [0], "offset": 5, "length": 2}))
+
+    storage = Storage()
+    storage.files["a.csv"] = b"head\n1\n"
+    journal = _journal(tmp_path, storage)
+    assert journal.wait_for_drain(timeout=5)
+    journal.close()
+    assert storage.batches == [("a.csv", [0], True, 5)]
+    assert storage.files == {"a.csv": b"head\n1\n"}
+    assert os.listdir(tmp_path) == []
+
+
+def test_marker_of_partly_removed_batch_is_discarded(tmp_path):
+    journal = _journal(tmp_path, Storage(fail=True))
+    journal.add("a.csv", [b"1\n"], append=True)
+    journal.add("a.csv", [b"2\n"], append=True)
+    journal.close(timeout=0.1)
+    # the batch was committed and the first manifest already removed
+    (tmp_path / "00000000000000000000.inflight").write_text(json.dumps(
+        {"path": "a.csv", "seqs": [0, 1], "offset": 0, "length": 4}))
+    os.remove(tmp_path / "00000000000000000000.json")
+
+    storage = Storage()
+    journal = _journal(tmp_path, storage)
+    assert journal.wait_for_drain(timeout=5)
+    journal.close()
+    assert storage.batches == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_retry_after_ambiguous_flush_does_not_append_twice(tmp_path, monkeypatch):
+    flush_data = FakeFileClient.flush_data
+    failures = []
+
+    def flaky_flush(self, offset, **kwargs):
+        # the flush is committed, but the response is lost once
+        result = flush_data(self, offset, **kwargs)
+        if offset > 5 and not failures:
+            failures.append(offset)
+            raise ServiceResponseError("connection reset")
+        return result
+
+    monkeypatch.setattr("azure_datalake_journal.DEFAULT_RETRY_BACKOFF", 0.01)
+    service = FakeDataLakeServiceClient()
+    client = AzureDatalakeV2(container_name="c", service_client=service)
+    client.write_dataframe("d/a.csv", pd.DataFrame({"head": []}))
+    monkeypatch.setattr(FakeFileClient, "flush_data", flaky_flush)
+
+    client = AzureDatalakeV2(container_name="c", service_client=service, journal_dir=str(tmp_path))
+    client.write_dataframe("d/a.csv", pd.DataFrame({"head": [1]}), append=True)
+    assert client.wait_for_drain(timeout=5)
+    client.close()
+    assert failures
+    assert client.read_bytes("d/a.csv") == b"head\n1\n"
+
+
+def test_read_of_pending_append_times_out(tmp_path):
+    service = FakeDataLakeServiceClient()
+    client = AzureDatalakeV2(container_name="c", service_client=service, journal_dir=str(tmp_path),
+                             journal_wait_timeout=0.1)
+    client.journal.upload = Storage(fail=True).upload
+    client.journal.add("d/a.csv", [b"1\n"], append=True)
+    with pytest.raises(JournalPending):
+        client.read_bytes("d/a.csv")
+    client.close(timeout=0)